@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+"""
+Command-line tool to benchmark hot paths of the NPF parser/renderer.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import re
+import timeit
+
+import emoji
+
+from fxtumblr.npf import NPFTextBlock, TumblrThread, is_large_emoji, strip_tags
+
+# Sample block texts, used if no post payloads are provided.
+SAMPLE_TEXTS = [
+    "😭😭😭",
+    "🫡",
+    "👨‍👩‍👧‍👦",
+    "🇵🇱🇺🇦",
+    "😀 😀",
+    "...what",
+    "(this is a parenthesized aside, which is pretty common in text posts)",
+    "“I can't believe you've done this”",
+    "<b>😳</b>",
+    '<a href="https://www.tumblr.com">#️⃣</a>',
+    "- a list-like line of text that isn't actually a list",
+    "&gt;implying",
+    "💀💀💀💀💀💀💀💀💀💀💀💀",
+    "🐸☕ " * 20,
+]
+
+parser = argparse.ArgumentParser(
+    prog="benchtool.py", description="Benchmarks for fxtumblr internals"
+)
+
+subparsers = parser.add_subparsers(title="mode")
+
+emoji_parser = subparsers.add_parser("emoji")
+emoji_parser.set_defaults(mode="emoji")
+emoji_parser.add_argument(
+    "posts",
+    nargs="*",
+    help="JSON files with post payloads (as returned by the Tumblr API) to take block text from",
+)
+emoji_parser.add_argument(
+    "-n", "--number", type=int, default=2000, help="Iterations per benchmark"
+)
+
+thread_parser = subparsers.add_parser("thread")
+thread_parser.set_defaults(mode="thread")
+thread_parser.add_argument(
+    "-d",
+    "--depths",
+    default="50,100,200",
+    help="Comma-separated trail lengths of the synthetic threads to benchmark",
+)
+thread_parser.add_argument(
+    "-n", "--number", type=int, default=50, help="Iterations per benchmark"
+)
+
+
+def legacy_is_large_emoji(text: str) -> bool:
+    """Large emoji detection as it was done before is_large_emoji was added."""
+    emoji_tuple = tuple(itertools.islice(emoji.analyze(text), 4))
+    emoji_and_char_tuple = tuple(
+        itertools.islice(emoji.analyze(re.sub(strip_tags, "", text), non_emoji=True), 4)
+    )
+    return len(emoji_tuple) <= 3 and [e.chars for e in emoji_tuple] == [
+        e.chars for e in emoji_and_char_tuple
+    ]
+
+
+def block_texts_from_payload(payload: dict) -> list:
+    """Returns HTML-formatted text of all text blocks in a post and its trail."""
+    if "response" in payload:
+        payload = payload["response"]
+    if "posts" in payload:
+        payload = payload["posts"][0]
+
+    texts = []
+    for post in payload.get("trail", []) + [payload]:
+        for block in post.get("content", []):
+            if block.get("type") != "text":
+                continue
+            texts.append(NPFTextBlock.from_payload(block).apply_formatting())
+    return texts
+
+
+def synthetic_thread_payload(depth: int) -> dict:
+    """Returns a post payload with a trail of the given length."""
+
+    def blog(i):
+        return {
+            "name": f"blog{i}",
+            "avatar": [
+                {"url": f"https://64.media.tumblr.com/avatar_{i}_64.png", "width": 64}
+            ],
+        }
+
+    def content(i):
+        return [
+            {"type": "text", "text": f"reblog number {i}, with some text"},
+            {
+                "type": "text",
+                "text": "and a second paragraph that is somewhat longer, " * 4,
+                "formatting": [{"start": 4, "end": 10, "type": "bold"}],
+            },
+        ]
+
+    trail = [
+        {
+            "blog": blog(i),
+            "post": {"id": str(1000 + i)},
+            "content": content(i),
+            "layout": [],
+        }
+        for i in range(depth)
+    ]
+
+    return {
+        "id": 1000 + depth,
+        "blog": blog(depth),
+        "timestamp": 0,
+        "trail": trail,
+        "content": content(depth),
+        "layout": [],
+        "tags": [],
+    }
+
+
+def legacy_thread_to_html(thread: TumblrThread) -> str:
+    """Thread HTML assembly as it was done before the fragment builder."""
+    result = thread.posts[0].to_html()
+    for prev, post in zip(thread.posts[:-1], thread.posts[1:]):
+        result = f"{prev.content.legacy_prefix_link}<blockquote>{result}</blockquote>{post.to_html()}"
+    return result
+
+embed_parser = subparsers.add_parser("embed")
+embed_parser.set_defaults(mode="embed")
+embed_parser.add_argument(
+    "-d", "--depth", type=int, default=5, help="Trail length of the synthetic post"
+)
+embed_parser.add_argument(
+    "-n", "--number", type=int, default=2000, help="Requests per benchmark"
+)
+
+
+async def asgi_get(asgi_app, path: str, user_agent: bytes = b"Discordbot/2.0"):
+    """Sends a GET request straight to an ASGI app; returns the status."""
+    status = None
+    received = False
+
+    async def receive():
+        nonlocal received
+        if received:
+            # Nothing more to send; the app waits for a disconnect here
+            await asyncio.Future()
+        received = True
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await asgi_app(
+        {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "root_path": "",
+            "query_string": b"",
+            "headers": [(b"host", b"localhost"), (b"user-agent", user_agent)],
+            "client": ("127.0.0.1", 12345),
+            "server": ("localhost", 80),
+            "extensions": {},
+        },
+        receive,
+        send,
+    )
+    return status
+
+
+def bench(func, texts, number) -> float:
+    """Returns the average time per block, in microseconds."""
+    total = timeit.timeit(lambda: [func(t) for t in texts], number=number)
+    return total / (number * len(texts)) * 1_000_000
+
+
+args = parser.parse_args()
+try:
+    mode = args.mode
+except:
+    print('No command provided! See "benchtool.py --help" for more information.')
+    quit(1)
+
+if mode == "emoji":
+    texts = []
+    for path in args.posts:
+        with open(path) as post_file:
+            texts += block_texts_from_payload(json.load(post_file))
+    if not texts:
+        texts = SAMPLE_TEXTS
+
+    # Only texts that would actually reach the check in NPFSubtype.format_html
+    texts = [t for t in texts if t and not t[0].isalnum()]
+    if not texts:
+        print("No block text starting with a non-alphanumeric character found.")
+        quit(1)
+
+    for text in texts:
+        if legacy_is_large_emoji(text) != is_large_emoji(text):
+            print(f"Mismatch between implementations for {text!r}")
+
+    legacy = bench(legacy_is_large_emoji, texts, args.number)
+    current = bench(is_large_emoji, texts, args.number)
+    print(f"{len(texts)} block(s), {args.number} iterations")
+    print(f"legacy:  {legacy:.2f} µs/block")
+    print(f"current: {current:.2f} µs/block ({legacy / current:.1f}x)")
+
+elif mode == "thread":
+    for depth in args.depths.split(","):
+        depth = int(depth)
+        thread = TumblrThread.from_payload(synthetic_thread_payload(depth))
+
+        if legacy_thread_to_html(thread) != thread.to_html():
+            print(f"Mismatch between implementations for depth {depth}")
+
+        legacy = timeit.timeit(lambda: legacy_thread_to_html(thread), number=args.number)
+        current = timeit.timeit(thread.to_html, number=args.number)
+        legacy = legacy / args.number * 1000
+        current = current / args.number * 1000
+        print(
+            f"depth {depth}: legacy {legacy:.2f} ms, current {current:.2f} ms ({legacy / current:.1f}x)"
+        )
+
+        # Same, but with pre-rendered posts, to measure only the assembly step
+        prefixes = [post.content.legacy_prefix_link for post in thread.posts]
+        posts_html = [post.to_html() for post in thread.posts]
+
+        def legacy_assembly():
+            result = posts_html[0]
+            for i in range(1, len(posts_html)):
+                result = f"{prefixes[i - 1]}<blockquote>{result}</blockquote>{posts_html[i]}"
+            return result
+
+        def current_assembly():
+            parts = []
+            for prefix in reversed(prefixes[:-1]):
+                parts.append(prefix)
+                parts.append("<blockquote>")
+            parts.append(posts_html[0])
+            for post_html in posts_html[1:]:
+                parts.append("</blockquote>")
+                parts.append(post_html)
+            return "".join(parts)
+
+        legacy = timeit.timeit(legacy_assembly, number=args.number * 10)
+        current = timeit.timeit(current_assembly, number=args.number * 10)
+        legacy = legacy / (args.number * 10) * 1_000_000
+        current = current / (args.number * 10) * 1_000_000
+        print(
+            f"depth {depth} (assembly only): legacy {legacy:.1f} µs, current {current:.1f} µs ({legacy / current:.1f}x)"
+        )
+
+elif mode == "embed":
+    import time
+
+    import fxtumblr.cards
+    import fxtumblr.embeds
+    from fxtumblr.app import app
+    from fxtumblr.fastpath import EmbedFastPath
+    from fxtumblr.jsoncodec import dumps
+    from fxtumblr.npf_schema import decode_posts_response
+    from fxtumblr.tumblr import post_from_response
+
+    payload = synthetic_thread_payload(args.depth)
+    payload |= {"blog_name": payload["blog"]["name"], "note_count": 1}
+    response = decode_posts_response(
+        dumps({"blog": payload["blog"], "posts": [payload]})
+    )
+    # Stand-in for a cache hit, so that this doesn't need valkey
+    fxtumblr.embeds.get_post = lambda *_args, **_kwargs: post_from_response(response)
+    fxtumblr.cards.EMBED_FAST_PATH = True
+
+    quart_app = app.asgi_app
+    # The fast path wraps the app without the proxy headers middleware
+    fast_app = EmbedFastPath(quart_app.app)
+    path = f"/{payload['blog_name']}/{payload['id']}"
+
+    async def run(asgi_app) -> float:
+        assert await asgi_get(asgi_app, path) == 200
+        start = time.perf_counter()
+        for _ in range(args.number):
+            await asgi_get(asgi_app, path)
+        return args.number / (time.perf_counter() - start)
+
+    async def main():
+        # The first request through Quart fills the card cache
+        quart = await run(quart_app)
+        fast = await run(fast_app)
+        print(f"{args.number} requests, trail length {args.depth}")
+        print(f"quart:     {quart:.0f} req/s")
+        print(f"fast path: {fast:.0f} req/s ({fast / quart:.1f}x)")
+
+    asyncio.run(main())
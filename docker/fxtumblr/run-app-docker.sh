@@ -6,6 +6,11 @@
 export PYTHONDONTWRITEBYTECODE=1
 export PYTHONUNBUFFERED=1
 
+# Used to aggregate metrics across workers; must be emptied on startup
+export PROMETHEUS_MULTIPROC_DIR=/tmp/fxtumblr-metrics
+rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+chown fxtumblr:fxtumblr "$PROMETHEUS_MULTIPROC_DIR"
+
 [ -e "stats.db" ] && chown -R fxtumblr:fxtumblr stats.db
 runuser -u fxtumblr -- hypercorn -w "${FXTUMBLR_WORKERS}" "fxtumblr.app" -b 0.0.0.0:"${FXTUMBLR_PORT}"
 exit $?
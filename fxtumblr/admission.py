@@ -0,0 +1,205 @@
+"""
+Admission control for the embed route.
+
+Each web worker only works on a limited number of embeds at once. Requests
+are split into priority classes (cached posts, posts that need to be fetched
+from Tumblr, forced renders); lower priority classes may only use part of
+the available slots, and waiting requests are let in by priority.
+
+When a request can't be let in within the queue timeout, it's degraded
+instead: forced renders are served without a render, posts that would need
+to be fetched are served from the cache even if it's stale, and only if
+none of that is possible is the request rejected (with a 503).
+"""
+
+import asyncio
+import heapq
+import itertools
+import math
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import Collection, Optional
+
+from .cache import canonical_blogname, post_is_cached, post_needs_caching
+from .config import config
+from .metrics import counter
+
+ADMISSION_MAX_CONCURRENT = int(config.get("admission_max_concurrent", 0))
+ADMISSION_QUEUE_TIMEOUT = float(config.get("admission_queue_timeout", 2))
+ADMISSION_RETRY_AFTER = int(config.get("admission_retry_after", 5))
+
+ADMISSION_SHED = counter(
+    "fxtumblr_admission_shed_total",
+    "Embed requests that were degraded or rejected due to load, by priority"
+    " class and action (norender, stale, rejected)",
+    ("priority", "action"),
+)
+
+
+class Priority(IntEnum):
+    CACHED = 0
+    FETCH = 1
+    RENDER = 2
+
+
+# Share of the concurrency limit that each priority class may use
+PRIORITY_SHARES = {
+    Priority.CACHED: 1.0,
+    Priority.FETCH: 0.75,
+    Priority.RENDER: 0.5,
+}
+
+
+class AdmissionController:
+    """Concurrency limiter with priority classes."""
+
+    def __init__(self, max_concurrent: int, queue_timeout: float):
+        self.max_concurrent = max_concurrent
+        self.queue_timeout = queue_timeout
+        self.limits = {
+            priority: max(1, math.floor(max_concurrent * share))
+            for priority, share in PRIORITY_SHARES.items()
+        }
+        self.active = 0
+        self._waiters = []
+        self._counter = itertools.count()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_concurrent > 0
+
+    def _prune(self) -> None:
+        while self._waiters and self._waiters[0][2].done():
+            heapq.heappop(self._waiters)
+
+    def try_acquire(self, priority: Priority) -> bool:
+        """Takes a slot if one is free right away."""
+        self._prune()
+        if self.active >= self.limits[priority]:
+            return False
+        if self._waiters and self._waiters[0][0] <= priority:
+            # Don't skip ahead of waiting requests of the same or higher priority
+            return False
+        self.active += 1
+        return True
+
+    async def acquire(self, priority: Priority) -> bool:
+        """Takes a slot, waiting for up to the queue timeout."""
+        if self.try_acquire(priority):
+            return True
+        if self.queue_timeout <= 0:
+            return False
+
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), fut))
+        try:
+            await asyncio.wait_for(fut, self.queue_timeout)
+        except asyncio.TimeoutError:
+            # release() may have handed us the slot just as the wait timed out
+            return fut.done() and not fut.cancelled()
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()
+            raise
+        return True
+
+    def release(self) -> None:
+        self.active -= 1
+        while self._waiters:
+            priority, _, fut = self._waiters[0]
+            if fut.done():
+                heapq.heappop(self._waiters)
+                continue
+            if self.active >= self.limits[priority]:
+                break
+            heapq.heappop(self._waiters)
+            self.active += 1
+            fut.set_result(True)
+
+
+class Admission:
+    """How an admitted embed request should be served."""
+
+    def __init__(self, priority: Priority):
+        self.priority = priority
+        #: Whether the card may point to a render
+        self.allow_render = True
+        #: Whether a stale cached post should be used instead of fetching it
+        self.stale = False
+        #: Whether the request was rejected; if so, return a 503
+        self.rejected = False
+        #: The canonical blog name and whether the post needs to be fetched,
+        #: if they were looked up (pass them on to get_post)
+        self.blogname = None
+        self.needs_caching = None
+
+
+controller = AdmissionController(ADMISSION_MAX_CONCURRENT, ADMISSION_QUEUE_TIMEOUT)
+
+
+@asynccontextmanager
+async def admit(
+    blogname: str,
+    postid: int,
+    args: Collection[str],
+    canonical: Optional[str] = None,
+    needs_caching: Optional[bool] = None,
+):
+    """
+    Waits for a slot to handle an embed request; yields an Admission.
+    Callers that already know the canonical blog name and whether the post
+    needs to be fetched can pass them in, so they're not looked up again.
+    """
+    if not controller.enabled:
+        admission = Admission(Priority.CACHED)
+        if needs_caching is not None:
+            admission.blogname = canonical
+            admission.needs_caching = needs_caching
+        yield admission
+        return
+
+    if needs_caching is None:
+        canonical = canonical_blogname(blogname)
+        needs_caching = post_needs_caching(canonical, postid)
+    cached = not needs_caching
+    if "forcerender" in args:
+        priority = Priority.RENDER
+    elif cached:
+        priority = Priority.CACHED
+    else:
+        priority = Priority.FETCH
+
+    admission = Admission(priority)
+    admission.blogname = canonical
+    admission.needs_caching = needs_caching
+    acquired = await controller.acquire(priority)
+
+    if not acquired and priority == Priority.RENDER:
+        fallback = Priority.CACHED if cached else Priority.FETCH
+        if controller.try_acquire(fallback):
+            acquired = True
+            admission.allow_render = False
+            ADMISSION_SHED.labels(priority=priority.name, action="norender").inc()
+
+    if (
+        not acquired
+        and not cached
+        and post_is_cached(canonical, postid)
+        and controller.try_acquire(Priority.CACHED)
+    ):
+        acquired = True
+        admission.stale = True
+        admission.needs_caching = False
+        admission.allow_render = priority != Priority.RENDER
+        ADMISSION_SHED.labels(priority=priority.name, action="stale").inc()
+
+    if not acquired:
+        admission.rejected = True
+        ADMISSION_SHED.labels(priority=priority.name, action="rejected").inc()
+        yield admission
+        return
+
+    try:
+        yield admission
+    finally:
+        controller.release()
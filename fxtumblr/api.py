@@ -0,0 +1,176 @@
+"""
+Contains the JSON API, for getting card data for many posts at once.
+"""
+
+import asyncio
+import traceback
+
+from quart import request
+
+from .admission import admit
+from .app import app
+from .cache import canonical_blogname, canonical_blognames, get_cached_posts
+from .cards import build_card_async
+from .config import config
+from .jsoncodec import DecodeError, dumps, loads
+from .metrics import CACHE_LOOKUPS
+from .ratelimit import check_rate_limit
+from .tumblr import get_post, post_from_response
+
+BATCH_MAX_POSTS = int(config.get("batch_max_posts", 50))
+BATCH_FETCH_CONCURRENCY = int(config.get("batch_fetch_concurrency", 4))
+
+# Query arguments that can be passed for each post
+BATCH_ARGS = ("unroll", "dark", "oldstyle", "forcerender")
+
+_fetch_semaphore = asyncio.Semaphore(BATCH_FETCH_CONCURRENCY)
+
+
+def _error(status: int, msg: str):
+    return (
+        dumps({"error": {"status": status, "msg": msg}}),
+        status,
+        {"Content-Type": "application/json"},
+    )
+
+
+def _parse_batch(data) -> list:
+    """Validates a batch request; returns a list of (blogname, postid, args)."""
+    if not isinstance(data, dict) or not isinstance(data.get("posts"), list):
+        raise ValueError('Expected an object with a "posts" list')
+    if len(data["posts"]) > BATCH_MAX_POSTS:
+        raise ValueError(f"At most {BATCH_MAX_POSTS} posts can be requested at once")
+
+    posts = []
+    for item in data["posts"]:
+        try:
+            blogname = item["blogname"]
+            postid = int(item["postid"])
+            args = item.get("args", [])
+        except (TypeError, KeyError, ValueError):
+            raise ValueError(
+                'Each post must be an object with "blogname" and "postid"'
+            ) from None
+        if not isinstance(blogname, str) or not blogname:
+            raise ValueError("Invalid blog name")
+        if not isinstance(args, list) or any(arg not in BATCH_ARGS for arg in args):
+            raise ValueError(f"args may only contain {', '.join(BATCH_ARGS)}")
+        posts.append((blogname, postid, args))
+    return posts
+
+
+async def _resolve(
+    index: int, blogname: str, canonical: str, postid: int, args: list, response
+):
+    """
+    Builds the result for one post; fetches it first if it wasn't cached.
+    Each post goes through admission control, like a regular embed.
+    """
+    result = {"index": index, "blogname": blogname, "postid": postid}
+
+    async with admit(
+        blogname, postid, args, canonical=canonical, needs_caching=response is None
+    ) as admission:
+        if admission.rejected:
+            result["error"] = {
+                "status": 503,
+                "msg": "fxtumblr is overloaded right now; please try again later.",
+            }
+            return result
+
+        try:
+            if response is None:
+                async with _fetch_semaphore:
+                    post = await asyncio.to_thread(
+                        get_post,
+                        blogname,
+                        postid,
+                        canonical=canonical,
+                        needs_caching=admission.needs_caching,
+                    )
+            else:
+                post = post_from_response(response)
+        except Exception:
+            traceback.print_exc()
+            result["error"] = {"status": 502, "msg": "Failed to get post"}
+            return result
+
+        if "error" in post:
+            meta = post.get("meta", {})
+            result["error"] = {
+                "status": meta.get("status", 500),
+                "msg": meta.get("msg", "Internal server error"),
+            }
+            return result
+
+        try:
+            # The post may have been fetched under a newly found alias
+            card = await build_card_async(
+                post,
+                canonical_blogname(blogname),
+                postid,
+                args,
+                admission.allow_render,
+            )
+        except Exception:
+            traceback.print_exc()
+            result["error"] = {"status": 500, "msg": "Failed to parse post"}
+            return result
+
+    card.pop("render_modifiers", None)
+    result["url"] = f"https://www.tumblr.com/{blogname}/{postid}"
+    result["card"] = card
+    return result
+
+
+@app.route("/api/posts", methods=["POST"])
+async def batch_posts():
+    """
+    Returns the card data for multiple posts. Expects a JSON object like:
+
+        {"posts": [{"blogname": "...", "postid": 123, "args": ["unroll"]}, ...]}
+
+    Results are streamed back as newline-delimited JSON as soon as they're
+    ready, so they may be out of order; each one contains the index of the
+    post in the request, and either the card or an error (e.g. a 503 if
+    the post was shed by admission control).
+    """
+    retry_after = check_rate_limit(
+        "batch", request.remote_addr, request.headers.get("User-Agent", "")
+    )
+    if retry_after:
+        body, status, headers = _error(429, "Too many requests")
+        return body, status, headers | {"Retry-After": str(retry_after)}
+
+    try:
+        posts = _parse_batch(loads(await request.get_data()))
+    except (DecodeError, ValueError) as e:
+        return _error(400, str(e))
+
+    canonical = canonical_blognames([blogname for blogname, _, _ in posts])
+    cached = get_cached_posts(
+        [(blogname, postid) for blogname, (_, postid, _) in zip(canonical, posts)]
+    )
+    # (misses are counted by get_post)
+    CACHE_LOOKUPS.labels(kind="post", result="hit").inc(
+        sum(response is not None for response in cached)
+    )
+
+    tasks = [
+        asyncio.create_task(
+            _resolve(i, blogname, canonical_name, postid, args, response)
+        )
+        for i, ((blogname, postid, args), canonical_name, response) in enumerate(
+            zip(posts, canonical, cached)
+        )
+    ]
+
+    async def stream():
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield dumps(await task) + b"\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return stream(), 200, {"Content-Type": "application/x-ndjson"}
@@ -1,26 +1,88 @@
-from quart import Quart, redirect, send_from_directory
+import time
+
+from quart import Quart, g, redirect, request, send_from_directory
 from quart_cors import cors
 from uvicorn.middleware.proxy_headers import ProxyHeadersMiddleware
 
 from .config import config
+from .metrics import (
+    METRICS_ENABLED,
+    REQUEST_DURATION,
+    mark_process_dead,
+    start_metrics_server,
+)
+from .timing import (
+    SERVER_TIMING,
+    SLOW_REQUEST_THRESHOLD,
+    server_timing_header,
+    start_timings,
+)
 
 # Initial setup to get things up and running
 app = Quart(__name__)  # Quart app
 app.config["EXPLAIN_TEMPLATE_LOADING"] = False  # workaround for jinja flask dependency?
-app.asgi_app = ProxyHeadersMiddleware(app.asgi_app, trusted_hosts=["127.0.0.1"])
 cors(app)
 
 
+@app.before_request
+async def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.timings = start_timings()
+
+
+@app.after_request
+async def add_server_timing(response):
+    if "request_start" not in g:
+        return response
+    timings = g.timings
+    total = (time.perf_counter() - g.request_start) * 1000
+    REQUEST_DURATION.labels(
+        route=request.url_rule.rule if request.url_rule else "unmatched",
+        status=str(response.status_code),
+    ).observe(total / 1000)
+    if SERVER_TIMING:
+        response.headers["Server-Timing"] = server_timing_header(timings, total)
+    if SLOW_REQUEST_THRESHOLD and total >= SLOW_REQUEST_THRESHOLD:
+        app.logger.warning(
+            f"Slow request: {request.method} {request.full_path} took {total:.1f}ms ("
+            + ", ".join(f"{stage}: {dur:.1f}ms" for stage, dur in timings.items())
+            + ")"
+        )
+    return response
+
+
+if METRICS_ENABLED:
+
+    @app.before_serving
+    async def serve_metrics():
+        start_metrics_server(
+            int(config.get("metrics_port", 6502)),
+            config.get("metrics_bind", "127.0.0.1"),
+        )
+
+    @app.after_serving
+    async def cleanup_metrics():
+        mark_process_dead()
+
+
 @app.route("/robots.txt")
 async def robots_txt():
     return await send_from_directory(app.static_folder, "robots.txt")
 
 
 from . import embeds  # noqa: F401,E402
+from . import api  # noqa: F401,E402
 
 if config["renders_enable"]:
     from . import renders  # noqa: F401
 
+asgi_app = app.asgi_app
+if config.get("embed_fast_path", False):
+    from .fastpath import EmbedFastPath
+
+    asgi_app = EmbedFastPath(asgi_app)
+app.asgi_app = ProxyHeadersMiddleware(asgi_app, trusted_hosts=["127.0.0.1"])
+
 
 @app.route("/")
 async def redirect_to_repo():
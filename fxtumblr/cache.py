@@ -2,52 +2,132 @@
 Contains code for managing the cache.
 """
 
-import json
 import time
 import datetime
 import dateutil
 import valkey
+from typing import List, Tuple
 
 from .config import config
+from .jsoncodec import loads, dumps
+from .lrucache import ExpiringLRUCache
+from .npf_schema import decode_posts_response
 
+# Responses are kept as bytes; JSON is decoded straight from them, and the
+# few plain string values are decoded where needed.
 r = valkey.Valkey(
     host=config.get("valkey_host", config.get("redis_host", "localhost")),
     port=config.get("valkey_port", config.get("redis_port", 6379)),
     password=config.get("valkey_password", config.get("redis_password", None)),
-    decode_responses=True,
+    decode_responses=False,
 )
 
 
+# Blog name aliases (different casing, old names, custom domains) are mapped
+# to the blog's canonical name, so that they all share one cache entry and
+# one render. Lookups are also kept in memory for a short while.
+ALIAS_EXPIRY = int(config.get("blog_alias_expiry", 7 * 24 * 60 * 60))
+_alias_cache = ExpiringLRUCache(
+    maxsize=int(config.get("blog_alias_cache_size", 4096)), max_age=300
+)
+
+
+def canonical_blogname(blogname: str) -> str:
+    """Returns the canonical name of a blog, if it's known to be an alias."""
+    return canonical_blognames([blogname])[0]
+
+
+def canonical_blognames(blognames: List[str]) -> List[str]:
+    """Same as canonical_blogname, for multiple blogs in one round trip."""
+    result = [_alias_cache.get(blogname.lower()) for blogname in blognames]
+    missing = [i for i, canonical in enumerate(result) if canonical is None]
+    if missing:
+        canonicals = r.mget(
+            [f"fxtumblr-blog-aliases:{blognames[i].lower()}" for i in missing]
+        )
+        for i, canonical in zip(missing, canonicals):
+            alias = blognames[i].lower()
+            result[i] = canonical.decode() if canonical else alias
+            _alias_cache.set(alias, result[i])
+    return result
+
+
+def record_blog_alias(alias: str, canonical: str) -> None:
+    """Remembers that alias refers to the blog with the canonical name."""
+    alias = alias.lower()
+    _alias_cache.set(alias, canonical)
+    if alias != canonical:
+        r.set(f"fxtumblr-blog-aliases:{alias}", canonical, ex=ALIAS_EXPIRY)
+
+
+def forget_blog_alias(alias: str) -> None:
+    """Drops the recorded canonical name of an alias (e.g. if it's stale)."""
+    alias = alias.lower()
+    _alias_cache.set(alias, alias)
+    r.delete(f"fxtumblr-blog-aliases:{alias}")
+
+
 def post_needs_caching(blogname, postid) -> bool:
-    cached = r.hgetall(f"fxtumblr-posts:{blogname}-{postid}")
-    if not cached:
+    cache_time = r.hget(f"fxtumblr-posts:{blogname}-{postid}", "cache_time")
+    if not cache_time:
         return True
-    if time.time() - float(cached["cache_time"]) >= config["cache_expiry"]:
+    if time.time() - float(cache_time) >= config["cache_expiry"]:
         return True
     return False
 
 
-def cache_post(blogname: str, postid: int, post: dict) -> None:
-    """Caches a post."""
-    if (
-        r.hgetall(f"fxtumblr-posts:{blogname}-{postid}")
-        and get_cached_post(blogname, postid) == post
-    ):
+def post_is_cached(blogname, postid) -> bool:
+    """Returns True if the post is in the cache, even if it's expired."""
+    return bool(r.hexists(f"fxtumblr-posts:{blogname}-{postid}", "post"))
+
+
+def cache_post(blogname: str, postid: int, post: dict) -> bytes:
+    """Caches a post. Returns the encoded post."""
+    encoded = dumps(post)
+    if r.hget(f"fxtumblr-posts:{blogname}-{postid}", "post") == encoded:
         r.hset(
             f"fxtumblr-posts:{blogname}-{postid}",
             mapping={"cache_time": time.time()},
         )
-        return
+        return encoded
 
     r.hset(
         f"fxtumblr-posts:{blogname}-{postid}",
-        mapping={"cache_time": time.time(), "post": json.dumps(post)},
+        mapping={"cache_time": time.time(), "post": encoded},
     )
-
-
-def get_cached_post(blogname: str, postid: int) -> dict:
-    """Returns a cached post, as received from Tumblr's API."""
-    return json.loads(r.hgetall(f"fxtumblr-posts:{blogname}-{postid}")["post"])
+    return encoded
+
+
+def get_cached_post(blogname: str, postid: int):
+    """
+    Returns a cached post, as received from Tumblr's API (decoded into
+    typed structs if available, see npf_schema).
+    """
+    return decode_posts_response(r.hget(f"fxtumblr-posts:{blogname}-{postid}", "post"))
+
+
+def get_cached_posts(keys: List[Tuple[str, int]]) -> list:
+    """
+    Gets multiple posts from the cache in one round trip. Returns the cached
+    response for each post (like get_cached_post), or None for posts that
+    aren't cached or have expired.
+    """
+    pipe = r.pipeline(transaction=False)
+    for blogname, postid in keys:
+        pipe.hmget(f"fxtumblr-posts:{blogname}-{postid}", "cache_time", "post")
+
+    now = time.time()
+    posts = []
+    for cache_time, post in pipe.execute():
+        if (
+            not post
+            or not cache_time
+            or now - float(cache_time) >= config["cache_expiry"]
+        ):
+            posts.append(None)
+        else:
+            posts.append(decode_posts_response(post))
+    return posts
 
 
 def poll_needs_caching(blogname, postid, pollid) -> bool:
@@ -55,7 +135,7 @@ def poll_needs_caching(blogname, postid, pollid) -> bool:
     if not poll:
         return True
 
-    poll = json.loads(poll)
+    poll = loads(poll)
     created_at = dateutil.parser.parse(poll["created_at"])
     expire_delta = datetime.timedelta(seconds=poll["settings"]["expire_after"])
     end_time = created_at + expire_delta
@@ -80,27 +160,26 @@ def cache_poll(blogname: str, postid: int, poll: dict) -> None:
     is_over = end_time <= now
     poll["is_over"] = is_over
 
-    r.set(f"fxtumblr-polls:{blogname}-{postid}-{pollid}", json.dumps(poll))
+    r.set(f"fxtumblr-polls:{blogname}-{postid}-{pollid}", dumps(poll))
 
 
 def get_cached_poll(blogname: str, postid: int, pollid: str) -> dict:
-    return json.loads(r.get(f"fxtumblr-polls:{blogname}-{postid}-{pollid}"))
+    return loads(r.get(f"fxtumblr-polls:{blogname}-{postid}-{pollid}"))
 
 
 def avatar_needs_caching(blogname) -> bool:
-    cached = r.hgetall(f"fxtumblr-avatars:{blogname}")
-    if not cached:
+    cache_time = r.hget(f"fxtumblr-avatars:{blogname}", "cache_time")
+    if not cache_time:
         return True
-    if time.time() - float(cached["cache_time"]) >= config["cache_expiry"]:
+    if time.time() - float(cache_time) >= config["cache_expiry"]:
         return True
     return False
 
 
 def cache_avatar(blogname: str, avatar_url: str) -> None:
     """Caches a avatar."""
-    if r.hgetall(f"fxtumblr-avatars:{blogname}") and get_cached_avatar(blogname) == (
-        avatar_url or ""
-    ):
+    cached = r.hget(f"fxtumblr-avatars:{blogname}", "avatar_url")
+    if cached is not None and cached.decode() == (avatar_url or ""):
         r.hset(
             f"fxtumblr-avatars:{blogname}",
             mapping={"cache_time": time.time()},
@@ -115,4 +194,4 @@ def cache_avatar(blogname: str, avatar_url: str) -> None:
 
 def get_cached_avatar(blogname: str) -> dict:
     """Returns a cached avatar, as received from Tumblr's API."""
-    return r.hgetall(f"fxtumblr-avatars:{blogname}")["avatar_url"] or None
+    return r.hget(f"fxtumblr-avatars:{blogname}", "avatar_url").decode() or None
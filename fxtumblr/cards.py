@@ -0,0 +1,348 @@
+"""
+Contains code for building the data shown in embed cards ("card models")
+from a post.
+
+This is kept separate from the web app, since it may also run in worker
+processes (see the embed_process_pool config option).
+"""
+
+import asyncio
+import concurrent.futures
+import re
+import signal
+from typing import Collection
+
+from .config import BASE_URL, config
+from .jsoncodec import loads, dumps
+from .lrucache import ExpiringLRUCache
+from .npf import TumblrThread, prefetch_payload_data
+from .npf_schema import decode_post
+from .timing import add_timings, start_timings, timed
+
+from fxtumblr_render.paths import filename_for
+
+# Descriptions are cut down to 349 characters at most; this is how much
+# post text is collected before we stop looking at further posts.
+DESCRIPTION_CAP = 1024
+
+# Query arguments that affect the card, other than ?video and ?audio (which
+# redirect to the media instead)
+CARD_ARGS = ("unroll", "dark", "oldstyle", "forcerender")
+
+# Built cards, for the embed fast path (see fastpath.py)
+EMBED_FAST_PATH = config.get("embed_fast_path", False)
+_card_cache = ExpiringLRUCache(
+    maxsize=int(config.get("card_cache_size", 4096)),
+    max_age=config["cache_expiry"],
+)
+
+EMBED_PROCESS_POOL = int(config.get("embed_process_pool", 0))
+EMBED_PROCESS_TIMEOUT = float(config.get("embed_process_timeout", 5))
+
+
+def build_card(
+    post, blogname: str, postid: int, args: Collection[str], allow_render: bool = True
+) -> dict:
+    """
+    Builds the card model for a post, as returned by get_post.
+
+    args contains the names of the query arguments passed to the embed.
+    If allow_render is False, the card never points to a render.
+    Returns a dict with either the template variables for card.html, or
+    a single "redirect" key with the URL to redirect to.
+    """
+    should_render = False
+
+    unroll = False
+    if "unroll" in args:
+        unroll = True
+
+    dark = False
+    if "dark" in args:
+        dark = True
+
+    if "forcerender" in args or config.get("renders_always_render", False):
+        should_render = True
+
+    with timed("parse"):
+        thread = TumblrThread.from_payload(post, unroll=unroll)
+        thread_info = thread.thread_info
+
+    # Get reblog information
+    reblog = {
+        "by": post.get(
+            "blog_name", post["blog"].get("name", post["blog"].get("broken_blog_name"))
+        ),
+        "from": post.get("reblogged_from_name"),
+    }
+
+    # Get title and embed description (post content)
+    try:
+        pfp = post["_fx_author_blog"]["avatar"][0]["url"]
+    except (KeyError, IndexError):
+        pfp = None
+
+    # Get embed description
+    with timed("description"):
+        description = ""
+
+        # Reblogs show up as empty posts in the thread so we have to ignore them.
+        # The description gets truncated later anyways, so stop once we have
+        # more than enough text to fill it.
+        tposts = []
+        tposts_length = 0
+        for p in thread.posts:
+            post_content = p.to_markdown(placeholders=True)
+            if not post_content.strip():
+                continue
+            tposts.append((p, post_content))
+            tposts_length += len(post_content)
+            if len(tposts) > 1 and tposts_length > DESCRIPTION_CAP:
+                break
+
+        if len(tposts) == 1:
+            tpost = tposts[0][0]
+            post_content = tpost.to_markdown(
+                placeholders=True, skip_single_placeholders=True
+            )
+            post_content = re.sub("^(\n)+", "\n", post_content)
+            if reblog["from"] and not tpost.is_collapsed:
+                description += f"▪ {tpost.blog_name}:\n"
+            description += post_content.strip()
+        else:
+            for tpost, post_content in tposts:
+                post_content = re.sub("^(\n)+", "\n", post_content)
+                if tpost.is_collapsed:
+                    description += "\n\n" + post_content.strip()
+                else:
+                    description += (
+                        f"\n\n▪ {tpost.blog_name}:\n" + post_content.strip()
+                    )
+
+        if post.get("is_submission", False):
+            description += f"\n\n(Submitted by {post.get('post_author')})"
+
+        if "tags" in post and post["tags"]:
+            description += "\n\n(#" + " #".join(post["tags"]) + ")"
+        description = description.strip()
+
+    # Get image(s) for thread
+    image = None
+    if thread_info.images:
+        if thread_info.images[0].original_dimensions:
+            target_width = thread_info.images[0].original_dimensions[0]
+        else:
+            target_width = 640  # pick whatever
+        image = thread_info.images[0]._pick_one_size(target_width)
+
+        if len(thread_info.images) > 1:
+            should_render = True
+
+    # Get video(s) for thread
+    video = None
+    video_thumbnail = None
+    if thread_info.videos:
+        if len(thread_info.videos) > 1:
+            should_render = True
+
+        try:
+            video = thread_info.videos[0][0].media[0]
+        except (IndexError, AttributeError):
+            # This usually happens when the video is an embed, in which case,
+            # we wanna render instead
+            should_render = True
+        else:
+            if "video" in args:
+                return {"redirect": video["url"]}
+
+            try:
+                video_thumbnail = thread_info.videos[0][1].media[0]["url"]
+            except (IndexError, AttributeError):
+                video_thumbnail = None
+
+    # Get audio for thread
+    if thread_info.audio:
+        if "audio" in args:
+            return {"redirect": thread_info.audio[0][0].media[0]["url"]}
+
+    # Truncate description (a maximum of 349 characters can be displayed, 256 for video desc)
+    if video:
+        truncate_placeholder = "... (click to see full thread)"
+        max_desc_length = 256 - len(truncate_placeholder)
+    else:
+        truncate_placeholder = "... (see full thread)"
+        max_desc_length = 349 - len(truncate_placeholder)
+
+    if len(description) > max_desc_length:
+        description = description[:max_desc_length] + truncate_placeholder
+        should_render = True
+
+    miniheader = f"{post['note_count']} notes"
+
+    if reblog["by"] and reblog["from"]:
+        if reblog["by"] == reblog["from"]:
+            header = reblog["by"] + " 🔁"
+        else:
+            header = reblog["by"] + " 🔁 " + reblog["from"]
+    else:
+        header = reblog[
+            "by"
+        ]  # this actually contains the op's blog name if there's no reblog
+
+    if image and video:
+        should_render = True
+
+    if thread_info.audio or thread_info.other_blocks:
+        should_render = True
+
+    if thread_info.has_formatting:
+        should_render = True
+
+    card_type = "tweet"
+    if image and not video:
+        card_type = "summary_large_image"
+    elif video and not image:
+        card_type = "video"
+
+    modifiers = []
+
+    if config["renders_enable"] and should_render and allow_render:
+        description = ""
+        if unroll:
+            modifiers.append("unroll")
+        if dark:
+            modifiers.append("dark")
+        if "oldstyle" in args:
+            modifiers.append("oldstyle")
+        render_path = (
+            BASE_URL
+            + "/renders/"
+            + filename_for(blogname, postid, extension="png", modifiers=modifiers)
+        )
+        image = {"url": render_path, "width": 0, "height": 0}
+        card_type = "summary_large_image"
+        if video:
+            description = f"(Hint: You can get the raw video by pasting in the following link: {BASE_URL}/{post['blog_name']}/{post['id']}?video)"
+
+        video = None
+    else:
+        should_render = False
+
+    return {
+        "card_type": card_type,
+        "image": image,
+        "pfp": pfp,
+        "video": video,
+        "video_thumbnail": video_thumbnail,
+        "header": header,
+        "miniheader": miniheader,
+        "op": reblog["by"],
+        "desc": description,
+        "is_rendered": should_render,
+        "render_modifiers": modifiers,
+    }
+
+
+def _card_cache_key(blogname: str, postid: int, args: Collection[str]) -> tuple:
+    return (blogname, postid, tuple(arg for arg in CARD_ARGS if arg in args))
+
+
+def cache_card(blogname: str, postid: int, args: Collection[str], card: dict) -> None:
+    """Keeps a built card around for the embed fast path."""
+    if not EMBED_FAST_PATH:
+        return
+    _card_cache.set(_card_cache_key(blogname, postid, args), card)
+
+
+def get_cached_card(blogname: str, postid: int, args: Collection[str]):
+    """Returns a previously built card, or None if there is none."""
+    return _card_cache.get(_card_cache_key(blogname, postid, args))
+
+
+def _cpu_timeout_handler(signum, frame):
+    raise TimeoutError("Embed generation took too much CPU time")
+
+
+def _init_worker():
+    signal.signal(signal.SIGPROF, _cpu_timeout_handler)
+
+
+def _build_card_in_worker(
+    post_data: bytes, blogname: str, postid: int, args: list, allow_render: bool
+) -> bytes:
+    """
+    Entry point for build_card in worker processes. Returns the card and the
+    stage timings collected while building it. The post must have been
+    passed through prefetch_payload_data first.
+    """
+    post = decode_post(post_data)
+    timings = start_timings()
+    # Limit the CPU time that a single post can take up; the wall clock time
+    # is limited by build_card_async.
+    signal.setitimer(signal.ITIMER_PROF, EMBED_PROCESS_TIMEOUT)
+    try:
+        card = build_card(post, blogname, postid, args, allow_render)
+    finally:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+    return dumps([card, timings])
+
+
+_pool = None
+
+
+def _get_pool() -> concurrent.futures.ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=EMBED_PROCESS_POOL, initializer=_init_worker
+        )
+    return _pool
+
+
+def _recycle_pool() -> None:
+    """Replaces the process pool, killing its (possibly stuck) workers."""
+    global _pool
+    pool, _pool = _pool, None
+    if pool is None:
+        return
+    # ProcessPoolExecutor can't cancel running calls; terminating the
+    # workers is the only way to get their slots back.
+    for process in list((getattr(pool, "_processes", None) or {}).values()):
+        process.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def build_card_async(
+    post, blogname: str, postid: int, args: Collection[str], allow_render: bool = True
+) -> dict:
+    """
+    Builds the card model for a post; runs in a worker process if the
+    process pool is enabled, inline otherwise.
+    """
+    if EMBED_PROCESS_POOL <= 0:
+        return build_card(post, blogname, postid, args, allow_render)
+
+    # Workers shouldn't wait on the cache or Tumblr's API, so anything that
+    # parsing the post would look up is fetched here first
+    await asyncio.to_thread(prefetch_payload_data, post)
+
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(
+        _get_pool(),
+        _build_card_in_worker,
+        dumps(post),
+        blogname,
+        postid,
+        list(args),
+        allow_render,
+    )
+    # The worker enforces the CPU time limit itself; this is a fallback
+    # for workers that are stuck on something else.
+    try:
+        result = await asyncio.wait_for(future, timeout=EMBED_PROCESS_TIMEOUT * 2)
+    except asyncio.TimeoutError:
+        _recycle_pool()
+        raise
+    card, timings = loads(result)
+    add_timings(timings)
+    return card
@@ -2,263 +2,188 @@
 Contains code for creating the embed.
 """
 
-import asyncio
 import logging
 import traceback
-import re
 from quart import request, render_template, redirect
 
 from .app import app
 from .config import APP_NAME, BASE_URL, config
-from .stats import register_hit
-from .npf import TumblrThread
-
-from fxtumblr_render.paths import filename_for
+from .admission import ADMISSION_RETRY_AFTER, Admission, admit
+from .ratelimit import check_rate_limit
+from .stats import register_hit, start_stats_writer, stop_stats_writer
+from .cache import canonical_blogname
+from .cards import build_card_async, cache_card
+from .timing import timed
+from .useragents import is_browser
 
 from .tumblr import get_post
 
+if config["renders_enable"]:
+    from .renders import prerender
+
 LOG_ENABLED = config.get("logging", False)
 STATS_ENABLED = config.get("statistics", False)
+REDIRECT_BROWSERS = config.get("redirect_browsers", False)
 
 logging.basicConfig(
     level=logging.INFO, format="[%(asctime)s] %(name)s:%(levelname)s %(message)s"
 )
 
-stats_tasks = set()
-
 
 @app.route("/<string:blogname>/<int:postid>")
 @app.route("/<string:blogname>/<int:postid>/")
 @app.route("/<string:blogname>/<int:postid>/<string:summary>")
 @app.route("/<string:blogname>/<int:postid>/<string:summary>/")
 async def generate_embed_route(blogname: str, postid: int, summary: str = None):
-    global stats_tasks
+    modifiers = []
+    for mod in ("unroll", "dark", "oldstyle"):
+        if mod in request.args:
+            modifiers.append(mod)
+
+    # The card only exists to redirect humans to Tumblr, so skip it (and the
+    # work needed to make it) for browsers. ?video and ?audio still need the
+    # post, since they redirect to the media itself.
+    if (
+        REDIRECT_BROWSERS
+        and "video" not in request.args
+        and "audio" not in request.args
+        and is_browser(request.headers.get("User-Agent", ""))
+    ):
+        count_hit(blogname, postid, modifiers)
+        return redirect(tumblr_url(blogname, postid, summary))
+
+    if request.method == "HEAD":
+        count_hit(blogname, postid, modifiers)
+        return "", 200, {"Content-Type": "text/html; charset=utf-8"}
+
+    retry_after = check_rate_limit(
+        "forcerender" if "forcerender" in request.args else "embed",
+        request.remote_addr,
+        request.headers.get("User-Agent", ""),
+    )
+    if retry_after:
+        return (
+            await render_template(
+                "error.html",
+                app_name=APP_NAME,
+                msg="Too many requests; please try again later.",
+            ),
+            429,
+            {"Retry-After": str(retry_after)},
+        )
 
     if LOG_ENABLED:
         app.logger.info(f"parsing post: https://www.tumblr.com/{blogname}/{postid}")
 
-    if STATS_ENABLED:
-        modifiers = []
-        for mod in ("unroll", "dark", "oldstyle"):
-            if mod in request.args:
-                modifiers.append(mod)
-
-    try:
-        ret = await generate_embed(blogname, postid, summary)
-    except:
-        app.logger.info(
-            f"Failed to parse post https://www.tumblr.com/{blogname}/{postid}:"
-        )
-        traceback.print_exc()
-        if STATS_ENABLED:
-            task = asyncio.create_task(
-                register_hit(blogname, postid, modifiers, failed=True)
+    async with admit(blogname, postid, request.args) as admission:
+        if admission.rejected:
+            if LOG_ENABLED:
+                app.logger.info(
+                    f"Shedding request for https://www.tumblr.com/{blogname}/{postid}"
+                )
+            return (
+                await render_template(
+                    "error.html",
+                    app_name=APP_NAME,
+                    msg="fxtumblr is overloaded right now; please try again later.",
+                ),
+                503,
+                {"Retry-After": str(ADMISSION_RETRY_AFTER)},
             )
-            stats_tasks.add(task)
-            task.add_done_callback(stats_tasks.discard)
-    else:
-        if STATS_ENABLED:
-            task = asyncio.create_task(
-                register_hit(blogname, postid, modifiers, failed=False)
-            )
-            stats_tasks.add(task)
-            task.add_done_callback(stats_tasks.discard)
-        return ret
-
 
-async def generate_embed(blogname: str, postid: int, summary: str = None):
-    should_render = False
-    post = get_post(blogname, postid)
-
-    post_tumblr_url = f"https://www.tumblr.com/{blogname}/{postid}"
-    if summary:
-        post_tumblr_url += f"/{summary}"
-
-    if "error" in post:
-        if post.get("meta", {}).get("status", 0) != 404:
+        try:
+            ret = await generate_embed(blogname, postid, summary, admission)
+        except:
             app.logger.info(
-                f"Error while parsing post https://www.tumblr.com/{blogname}/{postid}:"
+                f"Failed to parse post https://www.tumblr.com/{blogname}/{postid}:"
             )
-            app.logger.info(post)
-        return await parse_error(post, post_url=post_tumblr_url)
+            traceback.print_exc()
+            count_hit(blogname, postid, modifiers, failed=True)
+        else:
+            count_hit(blogname, postid, modifiers)
+            return ret
 
-    unroll = False
-    if "unroll" in request.args:
-        unroll = True
 
-    dark = False
-    if "dark" in request.args:
-        dark = True
+def count_hit(blogname: str, postid: int, modifiers: list, failed: bool = False):
+    """Registers a hit in the statistics, if enabled."""
+    if not STATS_ENABLED:
+        return
+    register_hit(blogname, postid, modifiers, failed=failed)
 
-    if "forcerender" in request.args or config.get("renders_always_render", False):
-        should_render = True
 
-    thread = TumblrThread.from_payload(post, unroll=unroll)
-    thread_info = thread.thread_info
+if STATS_ENABLED:
 
-    # Get reblog information
-    reblog = {
-        "by": post.get(
-            "blog_name", post["blog"].get("name", post["blog"].get("broken_blog_name"))
-        ),
-        "from": post.get("reblogged_from_name"),
-    }
+    @app.before_serving
+    async def start_stats():
+        start_stats_writer()
 
-    # Get title and embed description (post content)
-    try:
-        pfp = post["_fx_author_blog"]["avatar"][0]["url"]
-    except (KeyError, IndexError):
-        pfp = None
-
-    # Get embed description
-    description = ""
-
-    # Reblogs show up as empty posts in the thread so we have to ignore them
-    tposts = [p for p in thread.posts if p.to_markdown(placeholders=True).strip()]
-    if len(tposts) == 1:
-        tpost = tposts[0]
-        post_content = tpost.to_markdown(
-            placeholders=True, skip_single_placeholders=True
-        )
-        post_content = re.sub("^(\n)+", "\n", post_content)
-        if reblog["from"]:
-            description += f"▪ {tpost.blog_name}:\n"
-        description += post_content.strip()
-    else:
-        for tpost in tposts:
-            post_content = tpost.to_markdown(placeholders=True)
-            post_content = re.sub("^(\n)+", "\n", post_content)
-            description += f"\n\n▪ {tpost.blog_name}:\n" + post_content.strip()
-
-    if post.get("is_submission", False):
-        description += f"\n\n(Submitted by {post.get('post_author')})"
-
-    if "tags" in post and post["tags"]:
-        description += "\n\n(#" + " #".join(post["tags"]) + ")"
-    description = description.strip()
-
-    # Get image(s) for thread
-    image = None
-    if thread_info.images:
-        if thread_info.images[0].original_dimensions:
-            target_width = thread_info.images[0].original_dimensions[0]
-        else:
-            target_width = 640  # pick whatever
-        image = thread_info.images[0]._pick_one_size(target_width)
-
-        if len(thread_info.images) > 1:
-            should_render = True
+    @app.after_serving
+    async def flush_stats():
+        await stop_stats_writer()
 
-    # Get video(s) for thread
-    video = None
-    video_thumbnail = None
-    if thread_info.videos:
-        if len(thread_info.videos) > 1:
-            should_render = True
 
-        try:
-            video = thread_info.videos[0][0].media[0]
-        except (IndexError, AttributeError):
-            # This usually happens when the video is an embed, in which case,
-            # we wanna render instead
-            should_render = True
-        else:
-            if "video" in request.args:
-                return redirect(video["url"])
-
-            try:
-                video_thumbnail = thread_info.videos[0][1].media[0]["url"]
-            except (IndexError, AttributeError):
-                video_thumbnail = None
-
-    # Get audio for thread
-    if thread_info.audio:
-        if "audio" in request.args:
-            return redirect(thread_info.audio[0][0].media[0]["url"])
-
-    # Truncate description (a maximum of 349 characters can be displayed, 256 for video desc)
-    if video:
-        truncate_placeholder = "... (click to see full thread)"
-        max_desc_length = 256 - len(truncate_placeholder)
-    else:
-        truncate_placeholder = "... (see full thread)"
-        max_desc_length = 349 - len(truncate_placeholder)
+def tumblr_url(blogname: str, postid: int, summary: str = None) -> str:
+    """Returns the URL of the post on Tumblr."""
+    post_tumblr_url = f"https://www.tumblr.com/{blogname}/{postid}"
+    if summary:
+        post_tumblr_url += f"/{summary}"
+    return post_tumblr_url
 
-    if len(description) > max_desc_length:
-        description = description[:max_desc_length] + truncate_placeholder
-        should_render = True
 
-    miniheader = f"{post['note_count']} notes"
+async def generate_embed(
+    blogname: str, postid: int, summary: str = None, admission: Admission = None
+):
+    stale_ok = admission is not None and admission.stale
+    allow_render = admission is None or admission.allow_render
 
-    if reblog["by"] and reblog["from"]:
-        if reblog["by"] == reblog["from"]:
-            header = reblog["by"] + " 🔁"
-        else:
-            header = reblog["by"] + " 🔁 " + reblog["from"]
+    if admission is not None and admission.needs_caching is not None:
+        post = get_post(
+            blogname,
+            postid,
+            canonical=admission.blogname,
+            needs_caching=admission.needs_caching,
+        )
     else:
-        header = reblog[
-            "by"
-        ]  # this actually contains the op's blog name if there's no reblog
+        post = get_post(blogname, postid, stale_ok=stale_ok)
 
-    if image and video:
-        should_render = True
+    post_tumblr_url = tumblr_url(blogname, postid, summary)
+    # Renders are named after the canonical blog name, like cached posts
+    render_blogname = canonical_blogname(blogname)
 
-    if thread_info.audio or thread_info.other_blocks:
-        should_render = True
+    if "error" in post:
+        if post.get("meta", {}).get("status", 0) != 404:
+            app.logger.info(
+                f"Error while parsing post https://www.tumblr.com/{blogname}/{postid}:"
+            )
+            app.logger.info(post)
+        return await parse_error(post, post_url=post_tumblr_url)
 
-    if thread_info.has_formatting:
-        should_render = True
+    card = await build_card_async(
+        post, render_blogname, postid, list(request.args.keys()), allow_render
+    )
+    if "redirect" in card:
+        return redirect(card["redirect"])
 
-    card_type = "tweet"
-    if image and not video:
-        card_type = "summary_large_image"
-    elif video and not image:
-        card_type = "video"
+    if not stale_ok and allow_render:
+        cache_card(blogname, postid, request.args, card)
 
-    modifiers = []
+    if card["is_rendered"]:
+        prerender(render_blogname, postid, card["render_modifiers"], post)
 
-    if config["renders_enable"] and should_render:
-        description = ""
-        if unroll:
-            modifiers.append("unroll")
-        if dark:
-            modifiers.append("dark")
-        if "oldstyle" in request.args:
-            modifiers.append("oldstyle")
-        render_path = (
-            BASE_URL
-            + "/renders/"
-            + filename_for(blogname, postid, extension="png", modifiers=modifiers)
+    if LOG_ENABLED:
+        app.logger.info(
+            f"parsed post {blogname}/{postid}, rendered: {card['is_rendered']}"
         )
-        image = {"url": render_path, "width": 0, "height": 0}
-        card_type = "summary_large_image"
-        if video:
-            description = f"(Hint: You can get the raw video by pasting in the following link: {BASE_URL}/{post['blog_name']}/{post['id']}?video)"
-
-        video = None
-    else:
-        should_render = False
 
-    if LOG_ENABLED:
-        app.logger.info(f"parsed post {blogname}/{postid}, rendered: {should_render}")
-
-    return await render_template(
-        "card.html",
-        app_name=APP_NAME,
-        base_url=BASE_URL,
-        motd=config.get("motd", ""),
-        card_type=card_type,
-        posturl=post_tumblr_url,
-        image=image,
-        pfp=pfp,
-        video=video,
-        video_thumbnail=video_thumbnail,
-        header=header,
-        miniheader=miniheader,
-        op=reblog["by"],
-        desc=description,
-        is_rendered=should_render,
-    )
+    with timed("template"):
+        return await render_template(
+            "card.html",
+            app_name=APP_NAME,
+            base_url=BASE_URL,
+            motd=config.get("motd", ""),
+            posturl=post_tumblr_url,
+            **card,
+        )
 
 
 async def parse_error(info: dict, post_url: str = None):
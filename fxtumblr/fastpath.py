@@ -0,0 +1,166 @@
+"""
+Lean ASGI handler for the embed route.
+
+Crawlers tend to fetch the same few posts over and over. When the card for
+a post has already been built by this worker (see cards.cache_card), it's
+served straight from here, skipping Quart's routing, request context and
+middleware; so are browser redirects. Everything else (and anything this
+handler isn't sure about) is passed on to the Quart app.
+
+Responses get the same CORS and Server-Timing headers as the ones from the
+app, and are counted in the request duration metric under the same routes;
+the durations don't include the time the app spends on its own middleware,
+and fast requests are never logged as slow.
+"""
+
+import re
+import time
+from typing import Optional
+from urllib.parse import parse_qsl
+
+import jinja2
+
+from .cards import get_cached_card
+from .config import APP_NAME, BASE_URL, config
+from .embeds import REDIRECT_BROWSERS, count_hit, tumblr_url
+from .metrics import REQUEST_DURATION
+from .ratelimit import check_rate_limit
+from .timing import SERVER_TIMING, server_timing_header
+from .useragents import is_browser
+
+_embed_path_re = re.compile(r"^/([^/]+)/(\d+)(?:/([^/]+))?/?$")
+
+# Same environment settings as Quart's, so that the output is identical
+_template_env = jinja2.Environment(
+    loader=jinja2.PackageLoader("fxtumblr"), autoescape=True
+)
+_card_template = _template_env.get_template("card.html")
+
+
+def _route(summary: Optional[str], path: str) -> str:
+    """Returns the rule of the embed route the app would've matched."""
+    rule = "/<string:blogname>/<int:postid>"
+    if summary:
+        rule += "/<string:summary>"
+    if path.endswith("/"):
+        rule += "/"
+    return rule
+
+
+def _cors_headers(origin: Optional[bytes]) -> list:
+    """Returns the headers quart_cors adds with its default settings."""
+    if origin:
+        return [(b"access-control-allow-origin", b"*")]
+    return [(b"vary", b"Origin")]
+
+
+class EmbedFastPath:
+    """ASGI middleware that serves cached cards and browser redirects."""
+
+    def __init__(self, app):
+        self.app = app
+        self.motd = config.get("motd", "")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "GET":
+            return await self.app(scope, receive, send)
+
+        match = _embed_path_re.match(scope["path"])
+        if not match:
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        blogname, postid, summary = match.group(1), int(match.group(2)), match.group(3)
+        args = {
+            key for key, _ in parse_qsl(scope["query_string"].decode("latin-1"), True)
+        }
+        if "video" in args or "audio" in args:
+            return await self.app(scope, receive, send)
+
+        user_agent = ""
+        origin = None
+        for name, value in scope["headers"]:
+            if name == b"user-agent":
+                user_agent = value.decode("latin-1")
+            elif name == b"origin":
+                origin = value
+        route = _route(summary, scope["path"])
+
+        modifiers = [mod for mod in ("unroll", "dark", "oldstyle") if mod in args]
+
+        if REDIRECT_BROWSERS and is_browser(user_agent):
+            count_hit(blogname, postid, modifiers)
+            await self._respond(
+                send,
+                302,
+                b"",
+                [(b"location", tumblr_url(blogname, postid, summary).encode())],
+                start,
+                route,
+                origin,
+            )
+            return
+
+        card = get_cached_card(blogname, postid, args)
+        if card is None:
+            return await self.app(scope, receive, send)
+
+        client = scope.get("client")
+        retry_after = check_rate_limit(
+            "forcerender" if "forcerender" in args else "embed",
+            client[0] if client else "",
+            user_agent,
+        )
+        if retry_after:
+            await self._respond(
+                send,
+                429,
+                b"Too many requests; please try again later.",
+                [
+                    (b"content-type", b"text/plain; charset=utf-8"),
+                    (b"retry-after", str(retry_after).encode()),
+                ],
+                start,
+                route,
+                origin,
+            )
+            return
+
+        body = _card_template.render(
+            app_name=APP_NAME,
+            base_url=BASE_URL,
+            motd=self.motd,
+            posturl=tumblr_url(blogname, postid, summary),
+            **card,
+        ).encode()
+        count_hit(blogname, postid, modifiers)
+        await self._respond(
+            send,
+            200,
+            body,
+            [(b"content-type", b"text/html; charset=utf-8")],
+            start,
+            route,
+            origin,
+        )
+
+    async def _respond(
+        self,
+        send,
+        status: int,
+        body: bytes,
+        headers: list,
+        start: float,
+        route: str,
+        origin: Optional[bytes],
+    ) -> None:
+        headers = headers + _cors_headers(origin)
+        headers.append((b"content-length", str(len(body)).encode()))
+        total = time.perf_counter() - start
+        if SERVER_TIMING:
+            headers.append(
+                (b"server-timing", server_timing_header({}, total * 1000).encode())
+            )
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+        REQUEST_DURATION.labels(route=route, status=str(status)).observe(total)
@@ -0,0 +1,85 @@
+"""
+Contains the JSON codec used for the cache, the Tumblr API and the render
+server protocol.
+
+Uses orjson or msgspec if available (or if selected with the json_codec
+config option), and falls back to the standard library json module.
+"""
+
+import json
+from typing import Any, Union
+
+from .config import config
+
+JSON_CODEC = config.get("json_codec", "auto")
+if JSON_CODEC not in ("auto", "orjson", "msgspec", "json"):
+    raise ValueError("json_codec must be one of: auto, orjson, msgspec, json")
+
+if JSON_CODEC == "auto":
+    for _codec in ("orjson", "msgspec"):
+        try:
+            __import__(_codec)
+        except ImportError:
+            continue
+        JSON_CODEC = _codec
+        break
+    else:
+        JSON_CODEC = "json"
+
+
+def _default(obj: Any) -> Any:
+    # Typed payloads (see npf_schema) are msgspec structs
+    try:
+        import msgspec
+    except ImportError:
+        pass
+    else:
+        if isinstance(obj, msgspec.Struct):
+            return msgspec.to_builtins(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+if JSON_CODEC == "orjson":
+    import orjson
+
+    DecodeError = orjson.JSONDecodeError
+
+    def loads(data: Union[bytes, str]) -> Any:
+        """Decodes JSON from bytes or a string."""
+        return orjson.loads(data)
+
+    def dumps(obj: Any) -> bytes:
+        """Encodes an object to JSON bytes."""
+        return orjson.dumps(obj, default=_default)
+
+elif JSON_CODEC == "msgspec":
+    import msgspec
+
+    _decoder = msgspec.json.Decoder()
+    _encoder = msgspec.json.Encoder()
+
+    # msgspec.DecodeError is not a ValueError subclass, unlike the others
+    class DecodeError(ValueError):
+        pass
+
+    def loads(data: Union[bytes, str]) -> Any:
+        """Decodes JSON from bytes or a string."""
+        try:
+            return _decoder.decode(data)
+        except msgspec.DecodeError as e:
+            raise DecodeError(str(e)) from e
+
+    def dumps(obj: Any) -> bytes:
+        """Encodes an object to JSON bytes."""
+        return _encoder.encode(obj)
+
+else:
+    DecodeError = json.JSONDecodeError
+
+    def loads(data: Union[bytes, str]) -> Any:
+        """Decodes JSON from bytes or a string."""
+        return json.loads(data)
+
+    def dumps(obj: Any) -> bytes:
+        """Encodes an object to JSON bytes."""
+        return json.dumps(obj, default=_default).encode("utf-8")
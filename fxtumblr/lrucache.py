@@ -0,0 +1,32 @@
+"""
+Small in-process caches.
+"""
+
+import time
+from collections import OrderedDict
+
+
+class ExpiringLRUCache:
+    """Small in-process LRU cache with a maximum entry age."""
+
+    def __init__(self, maxsize: int, max_age: float):
+        self._maxsize = maxsize
+        self._max_age = max_age
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        try:
+            added, value = self._entries[key]
+        except KeyError:
+            return None
+        if time.monotonic() - added >= self._max_age:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value) -> None:
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
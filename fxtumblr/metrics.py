@@ -0,0 +1,157 @@
+"""
+Prometheus metrics for the web app and the render server.
+
+Requires prometheus_client and the "metrics" config option; otherwise, all
+metrics are no-ops. When running multiple hypercorn workers, set the
+PROMETHEUS_MULTIPROC_DIR environment variable to an empty directory (see
+run.sh) so that the metrics of all workers are aggregated.
+"""
+
+import os
+from typing import Sequence
+
+from .config import config
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+METRICS_ENABLED = prometheus_client is not None and config.get("metrics", False)
+MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+
+class _NoopMetric:
+    """Stand-in for metrics when they're disabled."""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount: float = 1) -> None:
+        pass
+
+    def dec(self, amount: float = 1) -> None:
+        pass
+
+    def set(self, value: float) -> None:
+        pass
+
+    def observe(self, value: float) -> None:
+        pass
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()):
+    if not METRICS_ENABLED:
+        return _NoopMetric()
+    return prometheus_client.Counter(name, documentation, labelnames)
+
+
+def histogram(
+    name: str, documentation: str, labelnames: Sequence[str] = (), buckets=None
+):
+    if not METRICS_ENABLED:
+        return _NoopMetric()
+    if buckets is None:
+        buckets = prometheus_client.Histogram.DEFAULT_BUCKETS
+    return prometheus_client.Histogram(
+        name, documentation, labelnames, buckets=buckets
+    )
+
+
+def gauge(name: str, documentation: str, labelnames: Sequence[str] = ()):
+    if not METRICS_ENABLED:
+        return _NoopMetric()
+    return prometheus_client.Gauge(
+        name, documentation, labelnames, multiprocess_mode="livesum"
+    )
+
+
+def start_metrics_server(port: int, addr: str) -> bool:
+    """
+    Serves the metrics over HTTP on a separate port, so that they're not
+    exposed on the public app. With multiple workers, the first worker to
+    bind the port serves the metrics of all of them (in multiprocess mode).
+    Returns whether this process is serving them.
+    """
+    if not METRICS_ENABLED:
+        return False
+    if MULTIPROCESS:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    try:
+        prometheus_client.start_http_server(port, addr, registry=registry)
+    except OSError:
+        # Another worker already serves them
+        return False
+    return True
+
+
+def mark_process_dead() -> None:
+    """Cleans up the metrics of an exiting worker (in multiprocess mode)."""
+    if METRICS_ENABLED and MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+REQUEST_DURATION = histogram(
+    "fxtumblr_request_duration_seconds",
+    "Time taken to handle requests, by route and response status",
+    ("route", "status"),
+)
+
+CACHE_LOOKUPS = counter(
+    "fxtumblr_cache_lookups_total",
+    "Cache lookups by type of cached data (post, poll, avatar) and result (hit, miss)",
+    ("kind", "result"),
+)
+
+TUMBLR_API_CALLS = counter(
+    "fxtumblr_tumblr_api_calls_total",
+    "Calls to Tumblr's API, by API key (index in the list of keys)",
+    ("key",),
+)
+
+TUMBLR_API_RATE_LIMITED = counter(
+    "fxtumblr_tumblr_api_rate_limited_total",
+    "Calls to Tumblr's API that were rate limited (429), by API key",
+    ("key",),
+)
+
+RENDER_QUEUE_DEPTH = gauge(
+    "fxtumblr_render_queue_depth", "Renders waiting for a render worker"
+)
+
+RENDER_WORKER_BUSY = counter(
+    "fxtumblr_render_worker_busy_seconds_total",
+    "Time render workers spent working on renders",
+    ("worker",),
+)
+
+RENDER_DURATION = histogram(
+    "fxtumblr_render_duration_seconds",
+    "Time taken to render a post (including fetching it), by result",
+    ("result",),
+    buckets=(0.25, 0.5, 1, 2, 3, 5, 7.5, 10, 15, 22, float("inf")),
+)
+
+BROWSER_RESTARTS = counter(
+    "fxtumblr_render_browser_restarts_total", "Times the render browser was restarted"
+)
+
+RENDER_FILE_SIZE = histogram(
+    "fxtumblr_render_file_size_bytes",
+    "Size of rendered images",
+    buckets=(
+        50_000,
+        100_000,
+        250_000,
+        500_000,
+        1_000_000,
+        2_500_000,
+        5_000_000,
+        10_000_000,
+        float("inf"),
+    ),
+)
@@ -5,18 +5,22 @@
 from typing import List, Optional, Tuple
 from collections import defaultdict
 from itertools import zip_longest
-from copy import deepcopy
+import functools
+import hashlib
 from markdownify import markdownify
 import html
 import nh3
 import urllib
 import datetime
 import dateutil.parser
-import itertools
 import emoji
 import re
 from urllib.parse import urlparse
 
+from .config import config
+from .jsoncodec import dumps
+from .lrucache import ExpiringLRUCache
+from .npf_schema import replace_payload
 from .tumblr import get_poll, get_avatar, DEFAULT_AVATAR
 
 strip_tags = re.compile("<.*?>")
@@ -32,7 +36,10 @@ def _get_blogname_from_payload(post_payload):
 def _get_avatar_from_payload(post_payload: dict) -> str:
     avatar = None
     if "blog" in post_payload:
-        if "avatar" in post_payload["blog"]:
+        if "_fxtumblr_avatar_url" in post_payload["blog"]:
+            # Looked up in advance by prefetch_payload_data
+            avatar = post_payload["blog"]["_fxtumblr_avatar_url"]
+        elif "avatar" in post_payload["blog"]:
             avatar_media = NPFMediaList(post_payload["blog"]["avatar"])
             avatar = avatar_media._pick_one_size(32)["url"]
         else:
@@ -42,64 +49,195 @@ def _get_avatar_from_payload(post_payload: dict) -> str:
     return avatar
 
 
+# Elements and attributes allowed in generated HTML; update these whenever
+# you add a new object.
+SANITIZE_TAGS = {
+    "p",
+    "b",
+    "i",
+    "a",
+    "small",
+    "strike",
+    "h1",
+    "h2",
+    "ul",
+    "ol",
+    "li",
+    "blockquote",
+    "span",
+    "div",
+    "figure",
+    "img",
+    "audio",
+    "video",
+    "source",
+    "svg",
+    "path",
+    "aside",
+    "use",
+}
+
+SANITIZE_ATTRIBUTES = {
+    "*": {"class", "id"},
+    "a": {"class", "id", "href"},
+    "div": {"class", "id", "style"},
+    "span": {"class", "id", "style"},
+    "figure": {"class", "id", "data-orig-height", "data-orig-width"},
+    "img": {"class", "id", "src", "data-orig-height", "data-orig-width"},
+    "video": {
+        "class",
+        "id",
+        "poster",
+        "src",
+        "controls",
+        "data-orig-height",
+        "data-orig-width",
+    },
+    "source": {"src", "type"},
+    "audio": {"class", "id", "poster", "src", "controls", "muted"},
+    "svg": {"class", "id", "xmlns", "height", "width", "role", "style"},
+    "use": {"class", "id", "href"},
+}
+
+try:
+    _sanitizer = nh3.Cleaner(tags=SANITIZE_TAGS, attributes=SANITIZE_ATTRIBUTES)
+except AttributeError:
+    # nh3 < 0.2.19 has no reusable cleaner
+    _sanitizer = None
+
+
+@functools.lru_cache(maxsize=config.get("sanitize_cache_size", 4096))
 def sanitize_html(html: str) -> str:
     """
     Sanitizes HTML to only include elements we add; second line of defense
     against arbitrary code execution.
 
-    Update this whenever you add a new object.
+    This is meant to be called on individual, self-contained fragments
+    (a single block, attribution, etc.); results are cached by fragment
+    content, so the same fragment is only sanitized once across renders.
     """
-    return nh3.clean(
-        html,
-        tags={
-            "p",
-            "b",
-            "i",
-            "a",
-            "small",
-            "strike",
-            "h1",
-            "h2",
-            "ul",
-            "ol",
-            "li",
-            "blockquote",
-            "span",
-            "div",
-            "figure",
-            "img",
-            "audio",
-            "video",
-            "source",
-            "svg",
-            "path",
-            "aside",
-            "use",
-        },
-        attributes={
-            "*": {"class", "id"},
-            "a": {"class", "id", "href"},
-            "div": {"class", "id", "style"},
-            "span": {"class", "id", "style"},
-            "figure": {"class", "id", "data-orig-height", "data-orig-width"},
-            "img": {"class", "id", "src", "data-orig-height", "data-orig-width"},
-            "video": {
-                "class",
-                "id",
-                "poster",
-                "src",
-                "controls",
-                "data-orig-height",
-                "data-orig-width",
-            },
-            "source": {"src", "type"},
-            "audio": {"class", "id", "poster", "src", "controls", "muted"},
-            "svg": {"class", "id", "xmlns", "height", "width", "role", "style"},
-            "use": {"class", "id", "href"},
-        },
+    if _sanitizer is not None:
+        return _sanitizer.clean(html)
+    return nh3.clean(html, tags=SANITIZE_TAGS, attributes=SANITIZE_ATTRIBUTES)
+
+
+# Limits for pathological posts; anything over these is cut off while parsing.
+MAX_TRAIL_DEPTH = int(config.get("max_trail_depth", 100))
+MAX_BLOCKS_PER_POST = int(config.get("max_blocks_per_post", 250))
+MAX_TEXT_LENGTH = int(config.get("max_text_length", 50000))
+
+
+def _split_trail(payload: dict) -> tuple:
+    """
+    Returns the start of the trail, the number of collapsed trail items and
+    the end of the trail. For very long threads, only the start and end of
+    the trail are kept, and everything in between is collapsed.
+    """
+    trail = payload.get("trail") or []
+    if len(trail) <= MAX_TRAIL_DEPTH:
+        return trail, 0, []
+    keep_head = MAX_TRAIL_DEPTH // 2
+    keep_tail = MAX_TRAIL_DEPTH - keep_head
+    return (
+        trail[:keep_head],
+        len(trail) - MAX_TRAIL_DEPTH,
+        trail[len(trail) - keep_tail :],
     )
 
 
+def prefetch_payload_data(payload: dict) -> None:
+    """
+    Looks up the avatars and poll results that parsing the post would need,
+    and stores them in the payload. Used before handing a post to a worker
+    process, so that workers don't block on the cache or Tumblr's API.
+    """
+    head, _, tail = _split_trail(payload)
+    for item in [*head, *tail, payload]:
+        blog = item.get("blog")
+        if blog is not None and "avatar" not in blog and "name" in blog:
+            blog["_fxtumblr_avatar_url"] = get_avatar(blog["name"])
+
+        if "id" in item:
+            id = item["id"]
+        elif "post" in item and "id" in item["post"]:
+            id = item["post"]["id"]
+        else:
+            continue
+        for bl in item["content"][:MAX_BLOCKS_PER_POST]:
+            if bl.get("type") == "poll" and "_fxtumblr_poll_results" not in bl:
+                # (an empty result is the same as a failed lookup when parsing)
+                bl["_fxtumblr_poll_results"] = (
+                    get_poll(
+                        _get_blogname_from_payload(item),
+                        str(id),
+                        bl["client_id"],
+                        bl,
+                    )
+                    or {}
+                )
+
+
+def _cap_text_block_payload(payload: dict, length: int) -> dict:
+    """Returns a copy of a text block payload with the text cut to length."""
+    formatting = []
+    for entry in payload.get("formatting", []):
+        if entry["start"] >= length:
+            continue
+        formatting.append(
+            {
+                "start": entry["start"],
+                "end": min(entry["end"], length),
+                "type": entry["type"],
+                "url": entry.get("url"),
+                "blog": entry.get("blog"),
+                "hex": entry.get("hex"),
+            }
+        )
+    return replace_payload(
+        payload, text=payload["text"][:length] + "…", formatting=formatting
+    )
+
+
+_trail_item_cache = ExpiringLRUCache(
+    maxsize=config.get("trail_cache_size", 2048),
+    max_age=config["cache_expiry"],
+)
+
+
+# Maximum amount of emoji that can be displayed in a large emoji block.
+LARGE_EMOJI_MAX_COUNT = 3
+# Longest possible emoji (ZWJ sequences, flags etc.), in code points.
+_EMOJI_MAX_LENGTH = max(len(e) for e in emoji.EMOJI_DATA)
+# ASCII characters that can start an emoji (keycap sequences).
+_EMOJI_ASCII_STARTERS = frozenset("#*0123456789")
+
+
+def is_large_emoji(text: str) -> bool:
+    """
+    Returns True if the (HTML-formatted) text of a block consists of only
+    up to LARGE_EMOJI_MAX_COUNT emoji and nothing else, in which case Tumblr
+    displays the emoji in a larger font.
+    """
+    if "<" in text:
+        text = re.sub(strip_tags, "", text)
+
+    if len(text) > LARGE_EMOJI_MAX_COUNT * _EMOJI_MAX_LENGTH:
+        return False
+
+    if text and text[0] < "\x80" and text[0] not in _EMOJI_ASCII_STARTERS:
+        return False
+
+    count = 0
+    for token in emoji.analyze(text, non_emoji=True):
+        if not isinstance(token.value, emoji.EmojiMatch):
+            return False
+        count += 1
+        if count > LARGE_EMOJI_MAX_COUNT:
+            return False
+
+    return True
+
+
 class TumblrContentBlockBase:
     def to_html(self) -> str:
         raise NotImplementedError
@@ -296,6 +434,17 @@ class NPFFormattingRange:
         self.blog = blog
         self.hex = hex
 
+    @staticmethod
+    def from_payload(payload: dict) -> "NPFFormattingRange":
+        return NPFFormattingRange(
+            start=payload["start"],
+            end=payload["end"],
+            type=payload["type"],
+            url=payload.get("url"),
+            blog=payload.get("blog"),
+            hex=payload.get("hex"),
+        )
+
     def to_html(self):
         result = {"start": self.start, "end": self.end}
 
@@ -383,16 +532,7 @@ class NPFSubtype:
         elif self.subtype == "quirky":
             ret = f'<span class="npf_quirky">{text_or_break}</span>'
         elif len(text) > 0 and not text[0].isalnum():
-            # We get 4 items here since we need to check if there aren't more than 3
-            emoji_tuple = tuple(itertools.islice(emoji.analyze(text), 4))
-            emoji_and_char_tuple = tuple(
-                itertools.islice(
-                    emoji.analyze(re.sub(strip_tags, "", text), non_emoji=True), 4
-                )
-            )
-            if len(emoji_tuple) <= 3 and [e.chars for e in emoji_tuple] == [
-                e.chars for e in emoji_and_char_tuple
-            ]:
+            if is_large_emoji(text):
                 ret = f'<p class="emoji-large">{text}</p>'
             else:
                 ret = f"<p>{text_or_break}</p>"
@@ -558,7 +698,8 @@ class NPFTextBlock(NPFBlock):
             subtype=NPFSubtype(subtype=payload.get("subtype", "no_subtype")),
             indent_level=payload.get("indent_level"),
             formatting=[
-                NPFFormattingRange(**entry) for entry in payload.get("formatting", [])
+                NPFFormattingRange.from_payload(entry)
+                for entry in payload.get("formatting", [])
             ],
         )
 
@@ -1096,6 +1237,18 @@ class NPFReadMoreBlock(NPFBlock, NPFNonTextBlockMixin):
         return "\n(keep reading)"
 
 
+class NPFCollapsedTrailBlock(NPFReadMoreBlock):
+    # Dummy block standing in for trail items skipped in very long threads
+    def __init__(self, count: int):
+        self.count = count
+
+    def to_html(self) -> str:
+        return f'<div class="read-more">{self.count:,} more reblog{"s" if self.count != 1 else ""} hidden</div>'
+
+    def to_markdown(self, placeholders: bool = False) -> str:
+        return f"\n({self.count:,} more reblog{'s' if self.count != 1 else ''})"
+
+
 class NPFSubmissionBlock(NPFBlock, NPFNonTextBlockMixin):
     # Dummy "Submitted by" block for submitted posts
     def __init__(self, submitted_by):
@@ -1192,6 +1345,118 @@ class NPFLayoutAsk(NPFLayout):
         )
 
 
+class NPFResolvedLayout:
+    """
+    Block order and row boundaries resolved from a post's layout entries.
+
+    This is computed once per NPFContent and reused whenever the annotated
+    blocks are rebuilt or the content is converted to HTML.
+    """
+
+    def __init__(
+        self,
+        ordered_ixs: List[int],
+        ask_ixs_to_layouts: dict,
+        truncated: bool,
+        row_lengths: dict,
+        row_ends: set,
+    ):
+        self._ordered_ixs = ordered_ixs
+        self._ask_ixs_to_layouts = ask_ixs_to_layouts
+        self._truncated = truncated
+        self._row_lengths = row_lengths
+        self._row_ends = row_ends
+
+    @property
+    def ordered_ixs(self) -> List[int]:
+        """Indices of the raw blocks, in display order."""
+        return self._ordered_ixs
+
+    @property
+    def ask_ixs_to_layouts(self) -> dict:
+        """Maps indices of blocks that are part of an ask to the ask layout."""
+        return self._ask_ixs_to_layouts
+
+    @property
+    def truncated(self) -> bool:
+        """Whether blocks were cut off by a "read more" marker."""
+        return self._truncated
+
+    @property
+    def row_lengths(self) -> dict:
+        """Maps the first block index of each multi-block row to its length."""
+        return self._row_lengths
+
+    @property
+    def row_ends(self) -> set:
+        """Last block indices of each multi-block row."""
+        return self._row_ends
+
+    @staticmethod
+    def from_layout(
+        layout: List[NPFLayout], n_blocks: int, unroll: bool = False
+    ) -> "NPFResolvedLayout":
+        if len(layout) == 0:
+            return NPFResolvedLayout(list(range(n_blocks)), {}, False, {}, set())
+
+        truncated = False
+        ordered_ixs = []
+        seen_ixs = set()
+        ask_ixs_to_layouts = {}
+        row_lengths = {}
+        row_ends = set()
+        all_ask = True
+
+        for layout_entry in layout:
+            if layout_entry.layout_type == "rows":
+                all_ask = False
+                truncate_after = None if unroll else layout_entry.truncate_after
+
+                for row_ixs in layout_entry.rows:
+                    if len(row_ixs) > 1:
+                        row_lengths[row_ixs[0]] = len(row_ixs)
+                        row_ends.add(row_ixs[-1])
+
+                for row_ixs in layout_entry.rows:
+                    if truncate_after is not None and (truncate_after + 1) in row_ixs:
+                        truncated = True
+
+                    # note: deduplication here is needed b/c of april 2021 tumblr npf ask bug
+                    for ix in row_ixs:
+                        if (
+                            ix in seen_ixs
+                            or ix >= n_blocks
+                            or (truncate_after is not None and ix > truncate_after)
+                        ):
+                            continue
+                        seen_ixs.add(ix)
+                        ordered_ixs.append(ix)
+
+                    if truncated:
+                        break
+            elif layout_entry.layout_type == "ask":
+                # note: deduplication here is needed b/c of april 2021 tumblr npf ask bug
+                for ix in layout_entry.blocks:
+                    if ix >= n_blocks:
+                        # block was cut off while parsing
+                        continue
+                    if ix not in seen_ixs:
+                        seen_ixs.add(ix)
+                        ordered_ixs.append(ix)
+                    ask_ixs_to_layouts[ix] = layout_entry
+            else:
+                all_ask = False
+
+        if all_ask:
+            ordered_ixs.extend(
+                ix for ix in range(n_blocks) if ix not in ask_ixs_to_layouts
+            )
+
+        return NPFResolvedLayout(
+            ordered_ixs, ask_ixs_to_layouts, truncated, row_lengths, row_ends
+        )
+
+
 class NPFBlockAnnotated(NPFBlock):
     def __init__(
         self,
@@ -1207,15 +1472,17 @@ class NPFBlockAnnotated(NPFBlock):
         self.ask_layout = ask_layout
 
     def reset_annotations(self):
-        new = NPFBlockAnnotated(base_block=self.base_block)
-        for attr, value in new.__dict__.items():
-            setattr(self, attr, value)
+        self.prefix = ""
+        self.suffix = ""
+        self.is_ask_block = False
+        self.ask_layout = None
 
     def as_ask_block(self, ask_layout: NPFLayoutAsk) -> "NPFBlockAnnotated":
-        new = deepcopy(self)
-        new.is_ask_block = True
-        new.ask_layout = ask_layout
-        return new
+        # The base block is never modified after parsing, so it can be shared
+        # between annotated blocks; only the annotations themselves are new.
+        return NPFBlockAnnotated(
+            base_block=self.base_block, is_ask_block=True, ask_layout=ask_layout
+        )
 
     @property
     def asking_name(self):
@@ -1226,7 +1493,9 @@ class NPFBlockAnnotated(NPFBlock):
         return self.ask_layout.asking_name
 
     def to_html(self) -> str:
-        inside = self.base_block.to_html()
+        # The prefix and suffix only contain (possibly unbalanced) wrapper
+        # tags generated by us, so only the block itself is sanitized.
+        inside = sanitize_html(self.base_block.to_html())
         return self.prefix + inside + self.suffix
 
     def to_markdown(self, placeholders: bool = False) -> str:
@@ -1256,6 +1525,7 @@ class NPFContent(TumblrContentBase):
         genesis_post_id: Optional[int] = None,
         post_url: Optional[str] = None,
         unroll: bool = False,
+        capped: bool = False,
     ):
         self.raw_blocks = [
             block if isinstance(block, NPFBlockAnnotated) else NPFBlockAnnotated(block)
@@ -1268,9 +1538,12 @@ class NPFContent(TumblrContentBase):
         self.genesis_post_id = genesis_post_id
         self._post_url = post_url
         self.unroll = unroll
-        self._truncated = False
+        self._capped = capped
+        self._truncated = capped
         self.is_submission = False
         self.submitted_by = None
+        self._ask_content = None
+        self._html_cache = {}
         if not unroll:
             for layout_entry in self.layout:
                 if (
@@ -1280,6 +1553,9 @@ class NPFContent(TumblrContentBase):
                     self._truncated = True
                     break
 
+        self._resolved_layout = NPFResolvedLayout.from_layout(
+            self.layout, len(self.raw_blocks), unroll=unroll
+        )
         self.blocks = self._make_blocks()
 
     @property
@@ -1291,73 +1567,32 @@ class NPFContent(TumblrContentBase):
 
     @property
     def legacy_prefix_link(self):
-        return f'<p><a class="tumblr_blog" href="{self.post_url}">{self.blog_name}</a>:</p>'
+        return sanitize_html(
+            f'<p><a class="tumblr_blog" href="{self.post_url}">{self.blog_name}</a>:</p>'
+        )
 
-    def _make_blocks(self) -> List[NPFBlockAnnotated]:
-        truncated = False
-        if len(self.layout) == 0:
-            ret = self.raw_blocks.copy()
-        else:
-            ordered_block_ixs = []
-            ask_ixs = set()
-            ask_ixs_to_layouts = {}
-            for layout_entry in self.layout:
-                if layout_entry.layout_type == "rows":
-                    for row_ixs in layout_entry.rows:
-                        if (
-                            not self.unroll
-                            and layout_entry.truncate_after is not None
-                            and (layout_entry.truncate_after + 1) in row_ixs
-                        ):
-                            truncated = True
-
-                        # note: deduplication here is needed b/c of april 2021 tumblr npf ask bug
-                        if not self.unroll:
-                            deduped_ixs = [
-                                ix
-                                for ix in row_ixs
-                                if ix not in ordered_block_ixs
-                                and (
-                                    layout_entry.truncate_after is None
-                                    or ix <= layout_entry.truncate_after
-                                )
-                            ]
-                        else:
-                            deduped_ixs = [
-                                ix for ix in row_ixs if ix not in ordered_block_ixs
-                            ]
-                        ordered_block_ixs.extend(deduped_ixs)
-                        if truncated:
-                            break
-                elif layout_entry.layout_type == "ask":
-                    # note: deduplication here is needed b/c of april 2021 tumblr npf ask bug
-                    deduped_ixs = [
-                        ix for ix in layout_entry.blocks if ix not in ordered_block_ixs
-                    ]
-                    ordered_block_ixs.extend(deduped_ixs)
-                    ask_ixs.update(layout_entry.blocks)
-                    ask_ixs_to_layouts.update(
-                        {ix: layout_entry for ix in layout_entry.blocks}
-                    )
+    @property
+    def resolved_layout(self) -> "NPFResolvedLayout":
+        return self._resolved_layout
 
-            if all([layout_entry.layout_type == "ask" for layout_entry in self.layout]):
-                extras = [ix for ix in range(len(self.raw_blocks)) if ix not in ask_ixs]
-                ordered_block_ixs.extend(extras)
-            ret = [
-                (
-                    self.raw_blocks[ix].as_ask_block(ask_layout=ask_ixs_to_layouts[ix])
-                    if ix in ask_ixs
-                    else self.raw_blocks[ix]
-                )
-                for ix in ordered_block_ixs
-            ]
+    def _make_blocks(self) -> List[NPFBlockAnnotated]:
+        resolved = self._resolved_layout
+        ask_ixs_to_layouts = resolved.ask_ixs_to_layouts
+        ret = [
+            (
+                self.raw_blocks[ix].as_ask_block(ask_layout=ask_ixs_to_layouts[ix])
+                if ix in ask_ixs_to_layouts
+                else self.raw_blocks[ix]
+            )
+            for ix in resolved.ordered_ixs
+        ]
 
         if self.is_submission:
             ret.append(
                 NPFBlockAnnotated(base_block=NPFSubmissionBlock(self.submitted_by))
             )
 
-        if truncated:
+        if resolved.truncated or self._capped:
             ret.append(NPFBlockAnnotated(base_block=NPFReadMoreBlock()))
 
         return ret
@@ -1402,8 +1637,22 @@ class NPFContent(TumblrContentBase):
         genesis_post_id = int(genesis_post_id) if genesis_post_id is not None else None
 
         blocks = []
-        for bl in payload["content"]:
-            if bl.get("type") == "poll" and id:
+        capped = False
+        text_length = 0
+        for n, bl in enumerate(payload["content"]):
+            if n >= MAX_BLOCKS_PER_POST or text_length >= MAX_TEXT_LENGTH:
+                capped = True
+                break
+            if bl.get("type") == "text" and "text" in bl:
+                if text_length + len(bl["text"]) > MAX_TEXT_LENGTH:
+                    bl = _cap_text_block_payload(bl, MAX_TEXT_LENGTH - text_length)
+                    capped = True
+                text_length += len(bl["text"])
+            if (
+                bl.get("type") == "poll"
+                and id
+                and "_fxtumblr_poll_results" not in bl
+            ):
                 # FIXME: Tumblr's poll API sucks and is missing half of the useful information.
                 # So, we have to provide the entire block payload to copy the poll data from.
                 bl["_fxtumblr_poll_results"] = get_poll(
@@ -1437,8 +1686,37 @@ class NPFContent(TumblrContentBase):
             genesis_post_id=genesis_post_id,
             post_url=post_url,
             unroll=unroll,
+            capped=capped,
         )
 
+    @staticmethod
+    def from_trail_payload(payload: dict, unroll: bool = False) -> "NPFContent":
+        """
+        Like from_payload, but for trail items. Since many reblogs of the same
+        post share the same trail items, parsed trail items are cached by
+        blog name, post ID, unroll setting and a digest of their content.
+        """
+        if any(bl.get("type") == "poll" for bl in payload["content"]):
+            # Poll results change over time
+            return NPFContent.from_payload(payload, unroll=unroll)
+
+        try:
+            post_id = payload["post"]["id"]
+        except KeyError:
+            post_id = None
+
+        digest = hashlib.blake2b(
+            dumps([payload.get("blog"), payload["content"], payload["layout"]]),
+            digest_size=16,
+        ).hexdigest()
+        key = (_get_blogname_from_payload(payload), post_id, digest, unroll)
+
+        content = _trail_item_cache.get(key)
+        if content is None:
+            content = NPFContent.from_payload(payload, unroll=unroll)
+            _trail_item_cache.set(key, content)
+        return content
+
     def _reset_annotations(self):
         for bl in self.blocks:
             bl.reset_annotations()
@@ -1536,23 +1814,27 @@ class NPFContent(TumblrContentBase):
             self.blocks[-1].suffix += _closing
 
     def to_html(self, wrap_blocks=False):
+        cache_key = (wrap_blocks, self.is_submission, self.submitted_by)
+        if cache_key in self._html_cache:
+            return self._html_cache[cache_key]
+
+        ret = self._to_html(wrap_blocks=wrap_blocks)
+
+        # Poll blocks show the remaining time, so they can't be cached
+        if not any(isinstance(bl.base_block, NPFPollBlock) for bl in self.raw_blocks):
+            self._html_cache[cache_key] = ret
+
+        return ret
+
+    def _to_html(self, wrap_blocks=False):
         self._reset_annotations()
         self._assign_html_indents(wrap_blocks=wrap_blocks)
 
         if wrap_blocks:
             ret = ""
 
-            row_start = []
-            row_lengths = {}
-            row_end = []
-            for lay in self.layout:
-                if lay.layout_type != "rows":
-                    continue
-                for row in lay.rows:
-                    if len(row) > 1:
-                        row_start.append(row[0])
-                        row_lengths[row[0]] = len(row)
-                        row_end.append(row[-1])
+            row_lengths = self._resolved_layout.row_lengths
+            row_ends = self._resolved_layout.row_ends
 
             n = len(self.ask_blocks)
             in_row = False
@@ -1561,21 +1843,21 @@ class NPFContent(TumblrContentBase):
                     block.base_block if isinstance(block, NPFBlockAnnotated) else block
                 )
 
-                if n in row_start:
+                if n in row_lengths:
                     ret += f'<div class="row-multiple row-{row_lengths[n]}">'
                     in_row = True
                 if in_row and base_block.attribution:
                     ret += (
                         "<div>"
                         + block.to_html()
-                        + base_block.attribution.to_html()
+                        + sanitize_html(base_block.attribution.to_html())
                         + "</div>"
                     )
                 else:
                     ret += block.to_html()
                     if not in_row and base_block.attribution:
-                        ret += base_block.attribution.to_html()
-                if n in row_end:
+                        ret += sanitize_html(base_block.attribution.to_html())
+                if n in row_ends:
                     ret += "</div>"
                     in_row = False
                 n += 1
@@ -1585,8 +1867,13 @@ class NPFContent(TumblrContentBase):
             )
 
         if len(self.ask_blocks) > 0:
+            question_header = sanitize_html(
+                f'<div class="question-header"><strong class="asking-name">{html.escape(self.ask_content.asking_name)}</strong> asked:</div>'
+            )
             ret = (
-                f'<div class="question"><div class="question-header"><strong class="asking-name">{html.escape(self.ask_content.asking_name)}</strong> asked:</div><div class="question-content">'
+                '<div class="question">'
+                + question_header
+                + '<div class="question-content">'
                 + "".join([block.to_html() for block in self.ask_blocks])
                 + "</div></div>"
                 + ret
@@ -1659,8 +1946,9 @@ class NPFContent(TumblrContentBase):
 
     @property
     def ask_content(self) -> Optional["NPFAsk"]:
-        if self.has_ask:
-            return NPFAsk.from_parent_content(self)
+        if self._ask_content is None and self.has_ask:
+            self._ask_content = NPFAsk.from_parent_content(self)
+        return self._ask_content
 
 
 class NPFAsk(NPFContent):
@@ -1681,9 +1969,13 @@ class NPFAsk(NPFContent):
     @staticmethod
     def from_parent_content(parent_content: NPFContent) -> Optional["NPFAsk"]:
         if parent_content.has_ask:
+            ask_layout = parent_content.ask_layout
             return NPFAsk(
-                blocks=deepcopy(parent_content.ask_blocks),
-                ask_layout=deepcopy(parent_content.ask_layout),
+                blocks=[
+                    bl.as_ask_block(ask_layout=bl.ask_layout or ask_layout)
+                    for bl in parent_content.ask_blocks
+                ],
+                ask_layout=ask_layout,
             )
 
 
@@ -1754,6 +2046,25 @@ class TumblrPost(TumblrPostBase):
         self._blog_name = blog_name
         self._content = content
         self._tags = tags
+        # Whether this is a placeholder for collapsed trail items
+        self.is_collapsed = False
+
+    @staticmethod
+    def collapsed_trail(count: int) -> "TumblrPost":
+        """Returns a placeholder post for collapsed trail items."""
+        blog_name = "..."
+        post = TumblrPost(
+            blog_name=blog_name,
+            content=NPFContent(
+                blocks=[NPFCollapsedTrailBlock(count)],
+                layout=[],
+                blog_name=blog_name,
+                avatar=DEFAULT_AVATAR,
+            ),
+            tags=[],
+        )
+        post.is_collapsed = True
+        return post
 
     @property
     def tags(self):
@@ -1784,7 +2095,8 @@ class TumblrPost(TumblrPostBase):
         return self._content.genesis_post_id
 
     def to_html(self, wrap_blocks=False) -> str:
-        return sanitize_html(self._content.to_html(wrap_blocks=wrap_blocks))
+        # Blocks are sanitized individually by the content
+        return self._content.to_html(wrap_blocks=wrap_blocks)
 
     def to_markdown(
         self, placeholders: bool = False, skip_single_placeholders: bool = False
@@ -1832,6 +2144,10 @@ class TumblrThreadInfo:
                     other_blocks.append(block)
                 elif isinstance(block, NPFPollBlock):
                     other_blocks.append(block)
+                elif isinstance(block, NPFCollapsedTrailBlock):
+                    # Collapsing the trail is meant to keep long threads cheap,
+                    # so it shouldn't make them get rendered
+                    pass
                 elif isinstance(block, NPFReadMoreBlock):
                     other_blocks.append(block)
                 elif block.media:
@@ -1950,15 +2266,24 @@ class TumblrThread:
 
     @staticmethod
     def from_payload(payload: dict, unroll: bool = False) -> "TumblrThread":
-        post_payloads = payload.get("trail", []) + [payload]
-        posts = [
-            TumblrPost(
+        trail, collapsed_count, trail_tail = _split_trail(payload)
+
+        def post_from_payload(post_payload):
+            return TumblrPost(
                 blog_name=_get_blogname_from_payload(post_payload),
-                content=NPFContent.from_payload(post_payload, unroll=unroll),
+                content=(
+                    NPFContent.from_payload(post_payload, unroll=unroll)
+                    if post_payload is payload
+                    else NPFContent.from_trail_payload(post_payload, unroll=unroll)
+                ),
                 tags=post_payload.get("tags", []),
             )
-            for post_payload in post_payloads
-        ]
+
+        posts = [post_from_payload(post_payload) for post_payload in trail]
+        if collapsed_count:
+            posts.append(TumblrPost.collapsed_trail(collapsed_count))
+        posts += [post_from_payload(post_payload) for post_payload in trail_tail]
+        posts.append(post_from_payload(payload))
         id = payload["id"]
         blog_name = _get_blogname_from_payload(payload)
         avatar = _get_avatar_from_payload(payload)
@@ -1985,22 +2310,27 @@ class TumblrThread:
             submitted_by,
         )
 
-    @staticmethod
-    def _format_post_as_quoting_previous(
-        post: TumblrPost, prev: TumblrPost, quoted: str
-    ) -> str:
-        return f"{prev.content.legacy_prefix_link}<blockquote>{quoted}</blockquote>{post.to_html()}"
-
     def to_html(self) -> str:
-        result = ""
-
-        post_part = self.posts[0].to_html()
-        result += post_part
-
-        for prev, post in zip(self.posts[:-1], self.posts[1:]):
-            result = TumblrThread._format_post_as_quoting_previous(post, prev, result)
-
-        return sanitize_html(result)
+        # Each post quotes the previous one, so the result looks like:
+        #   prefix(n-2) <blockquote> ... prefix(0) <blockquote> post(0)
+        #   </blockquote> post(1) ... </blockquote> post(n-1)
+        # This is built in a single pass to avoid re-copying the nested
+        # result for every trail item.
+        parts = []
+        for prev in reversed(self.posts[:-1]):
+            # (the placeholder for collapsed trail items has no post to link to)
+            if not prev.is_collapsed:
+                parts.append(prev.content.legacy_prefix_link)
+            parts.append("<blockquote>")
+
+        parts.append(self.posts[0].to_html())
+
+        for post in self.posts[1:]:
+            parts.append("</blockquote>")
+            parts.append(post.to_html())
+
+        # All parts of the result have already been sanitized
+        return "".join(parts)
 
     def to_markdown(
         self, placeholders: bool = False, skip_single_placeholders: bool = False
@@ -0,0 +1,212 @@
+"""
+Typed schema for the parts of Tumblr's API responses that we actually use
+(posts, trail items, NPF content blocks, layouts and media).
+
+If msgspec is installed, cached and fetched posts are decoded straight into
+these structs instead of nested dicts; unknown fields are skipped. The
+structs can be accessed like the dicts they replace (payload["key"],
+payload.get("key"), "key" in payload), so the NPF*.from_payload methods
+work with both. A field that is missing or null is treated as absent.
+
+Without msgspec (or with typed_payloads disabled in the config), posts are
+decoded into plain dicts.
+"""
+
+from typing import Any, Dict, List, Optional, Union
+
+from .config import config
+from .jsoncodec import loads
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+TYPED_PAYLOADS = msgspec is not None and config.get("typed_payloads", True)
+
+
+def to_builtins(payload: Any) -> Any:
+    """Converts a (possibly typed) payload into plain dicts and lists."""
+    if msgspec is None or isinstance(payload, (dict, list)):
+        return payload
+    return msgspec.to_builtins(payload)
+
+
+def replace_payload(payload: Any, **changes) -> Any:
+    """Returns a copy of a (possibly typed) payload with the given fields changed."""
+    if isinstance(payload, dict):
+        return payload | changes
+    return msgspec.structs.replace(payload, **changes)
+
+
+if msgspec is not None:
+    _key_maps = {}
+
+    def _attr_for_key(cls, key: str) -> str:
+        try:
+            key_map = _key_maps[cls]
+        except KeyError:
+            key_map = _key_maps[cls] = dict(
+                zip(cls.__struct_encode_fields__, cls.__struct_fields__)
+            )
+        return key_map.get(key, key)
+
+    class PayloadStruct(msgspec.Struct, omit_defaults=True):
+        """Base for payload structs; provides dict-like access to fields."""
+
+        def __getitem__(self, key: str) -> Any:
+            value = getattr(self, _attr_for_key(type(self), key), None)
+            if value is None:
+                raise KeyError(key)
+            return value
+
+        def __setitem__(self, key: str, value: Any) -> None:
+            setattr(self, _attr_for_key(type(self), key), value)
+
+        def __contains__(self, key: str) -> bool:
+            return getattr(self, _attr_for_key(type(self), key), None) is not None
+
+        def get(self, key: str, default: Any = None) -> Any:
+            value = getattr(self, _attr_for_key(type(self), key), None)
+            if value is None:
+                return default
+            return value
+
+    class Media(PayloadStruct):
+        url: Optional[str] = None
+        type: Optional[str] = None
+        width: Optional[int] = None
+        height: Optional[int] = None
+        has_original_dimensions: Optional[bool] = None
+
+    class BlogRef(PayloadStruct):
+        name: Optional[str] = None
+        url: Optional[str] = None
+        uuid: Optional[str] = None
+        avatar: Optional[List[Media]] = None
+        fxtumblr_avatar_url: Optional[str] = msgspec.field(
+            default=None, name="_fxtumblr_avatar_url"
+        )
+
+    class Attribution(PayloadStruct):
+        type: Optional[str] = None
+        url: Optional[str] = None
+        blog: Optional[BlogRef] = None
+        app_name: Optional[str] = None
+        display_text: Optional[str] = None
+
+    class FormattingRange(PayloadStruct):
+        start: int
+        end: int
+        type: str
+        url: Optional[str] = None
+        blog: Optional[BlogRef] = None
+        hex: Optional[str] = None
+
+    class PollAnswer(PayloadStruct):
+        client_id: Optional[str] = None
+        answer_text: Optional[str] = None
+
+    class ContentBlock(PayloadStruct):
+        type: Optional[str] = None
+        # text
+        text: Optional[str] = None
+        subtype: Optional[str] = None
+        indent_level: Optional[int] = None
+        formatting: Optional[List[FormattingRange]] = None
+        # media (image blocks have a list, video/audio blocks a single entry)
+        media: Union[List[Media], Media, None] = None
+        poster: Optional[List[Media]] = None
+        alt_text: Optional[str] = None
+        caption: Optional[str] = None
+        embed_html: Optional[str] = None
+        provider: Optional[str] = None
+        attribution: Optional[Attribution] = None
+        title: Optional[str] = None
+        artist: Optional[str] = None
+        album: Optional[str] = None
+        # link
+        url: Optional[str] = None
+        description: Optional[str] = None
+        author: Optional[str] = None
+        site_name: Optional[str] = None
+        display_url: Optional[str] = None
+        # poll
+        client_id: Optional[str] = None
+        question: Optional[str] = None
+        answers: Optional[List[PollAnswer]] = None
+        created_at: Optional[str] = None
+        settings: Optional[Dict[str, Any]] = None
+        fxtumblr_poll_results: Optional[Dict[str, Any]] = msgspec.field(
+            default=None, name="_fxtumblr_poll_results"
+        )
+
+    class LayoutRow(PayloadStruct):
+        blocks: List[int]
+
+    class Layout(PayloadStruct):
+        type: Optional[str] = None
+        display: Optional[List[LayoutRow]] = None
+        truncate_after: Optional[int] = None
+        blocks: Optional[List[int]] = None
+        attribution: Optional[Attribution] = None
+
+    class TrailPostRef(PayloadStruct):
+        id: Union[int, str, None] = None
+
+    class Post(PayloadStruct):
+        """A post, or an item in a post's trail."""
+
+        id: Union[int, str, None] = None
+        blog: Optional[BlogRef] = None
+        blog_name: Optional[str] = None
+        broken_blog_name: Optional[str] = None
+        post: Optional[TrailPostRef] = None
+        post_url: Optional[str] = None
+        genesis_post_id: Union[int, str, None] = None
+        timestamp: Optional[int] = None
+        title: Optional[str] = None
+        note_count: Optional[int] = None
+        tags: Optional[List[str]] = None
+        is_submission: Optional[bool] = None
+        post_author: Optional[str] = None
+        reblogged_from_id: Union[int, str, None] = None
+        reblogged_from_name: Optional[str] = None
+        content: List[ContentBlock] = []
+        layout: List[Layout] = []
+        trail: Optional[List["Post"]] = None
+        fx_author_blog: Optional[BlogRef] = msgspec.field(
+            default=None, name="_fx_author_blog"
+        )
+
+    class PostsResponse(PayloadStruct):
+        blog: Optional[BlogRef] = None
+        broken_blog_name: Optional[str] = None
+        posts: List[Post] = []
+
+    _posts_response_decoder = msgspec.json.Decoder(PostsResponse)
+    _post_decoder = msgspec.json.Decoder(Post)
+
+
+def decode_posts_response(data: bytes) -> Any:
+    """
+    Decodes a (cached) response from Tumblr's posts endpoint. Returns typed
+    structs if available, or plain dicts otherwise.
+    """
+    if TYPED_PAYLOADS:
+        try:
+            return _posts_response_decoder.decode(data)
+        except msgspec.ValidationError:
+            # Tumblr changed something we didn't expect; fall back to dicts
+            pass
+    return loads(data)
+
+
+def decode_post(data: bytes) -> Any:
+    """Decodes a single post; see decode_posts_response."""
+    if TYPED_PAYLOADS:
+        try:
+            return _post_decoder.decode(data)
+        except msgspec.ValidationError:
+            pass
+    return loads(data)
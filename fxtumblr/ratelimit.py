@@ -0,0 +1,124 @@
+"""
+Per-client rate limiting, shared across workers through valkey.
+
+Clients are grouped by network prefix (/32 for IPv4 and /64 for IPv6 by
+default), and each group gets a sliding window limit per route class
+(embeds, forced renders, renders, batch API requests). Allowlisted networks
+are never limited; allowlisted user agents (which anyone can claim to be)
+only get a higher limit.
+"""
+
+import functools
+import ipaddress
+import re
+import time
+from typing import Optional
+
+import valkey
+
+from .cache import r
+from .config import config
+from .metrics import counter
+
+RATE_LIMIT_ENABLED = config.get("rate_limit", False)
+
+# (requests, window in seconds) for each route class
+DEFAULT_RATE_LIMITS = {
+    "embed": (120, 60),
+    "forcerender": (10, 60),
+    "render": (60, 60),
+    "batch": (10, 60),
+}
+RATE_LIMITS = DEFAULT_RATE_LIMITS | {
+    route: tuple(limit) for route, limit in config.get("rate_limits", {}).items()
+}
+
+RATE_LIMIT_IPV4_PREFIX = int(config.get("rate_limit_ipv4_prefix", 32))
+RATE_LIMIT_IPV6_PREFIX = int(config.get("rate_limit_ipv6_prefix", 64))
+
+RATE_LIMIT_ALLOWED_NETWORKS = [
+    ipaddress.ip_network(net, strict=False)
+    for net in config.get("rate_limit_allowed_networks", [])
+]
+
+# Chat platforms fetch each link once per share, so their crawlers can
+# legitimately make a lot of requests; these get their limits multiplied.
+# The user agent is easy to fake, so none are allowlisted by default.
+RATE_LIMIT_ALLOWED_USER_AGENTS = config.get("rate_limit_allowed_user_agents", [])
+RATE_LIMIT_USER_AGENT_MULTIPLIER = float(
+    config.get("rate_limit_user_agent_multiplier", 10)
+)
+
+_allowed_ua_re = (
+    re.compile(
+        "|".join(re.escape(ua) for ua in RATE_LIMIT_ALLOWED_USER_AGENTS),
+        re.IGNORECASE,
+    )
+    if RATE_LIMIT_ALLOWED_USER_AGENTS
+    else None
+)
+
+RATE_LIMITED = counter(
+    "fxtumblr_rate_limited_total", "Requests denied by the rate limiter", ("route",)
+)
+
+
+@functools.lru_cache(maxsize=4096)
+def client_network(addr: str) -> Optional[str]:
+    """
+    Returns the network (prefix) that the client address is grouped under,
+    or None if it's allowlisted (or not an IP address).
+    """
+    try:
+        ip = ipaddress.ip_address(addr)
+    except ValueError:
+        return None
+    if any(ip in net for net in RATE_LIMIT_ALLOWED_NETWORKS):
+        return None
+    prefix = RATE_LIMIT_IPV4_PREFIX if ip.version == 4 else RATE_LIMIT_IPV6_PREFIX
+    return str(ipaddress.ip_network(f"{ip}/{prefix}", strict=False))
+
+
+def check_rate_limit(route: str, addr: str, user_agent: str = "") -> Optional[int]:
+    """
+    Counts a request from the given client address against the limit for
+    the route class. Returns None if the request is allowed, or the number
+    of seconds to wait before retrying if it isn't.
+
+    Uses a sliding window counter: the count for the current window plus
+    the previous window's count, weighted by how much of it still overlaps
+    the sliding window.
+    """
+    if not RATE_LIMIT_ENABLED or route not in RATE_LIMITS:
+        return None
+    network = client_network(addr)
+    if network is None:
+        return None
+
+    limit, window = RATE_LIMITS[route]
+    key = f"fxtumblr-ratelimit:{route}:{network}"
+    if user_agent and _allowed_ua_re is not None and _allowed_ua_re.search(user_agent):
+        # Counted separately, so that other clients on the same network
+        # don't eat into the crawler's limit
+        limit *= RATE_LIMIT_USER_AGENT_MULTIPLIER
+        key += ":ua"
+
+    now = time.time()
+    current_window = int(now // window)
+
+    try:
+        pipe = r.pipeline(transaction=False)
+        pipe.incr(f"{key}:{current_window}")
+        pipe.expire(f"{key}:{current_window}", int(window * 2))
+        pipe.get(f"{key}:{current_window - 1}")
+        current, _, previous = pipe.execute()
+    except valkey.exceptions.ValkeyError:
+        # Don't take the site down with the cache
+        return None
+
+    overlap = 1 - (now % window) / window
+    if int(previous or 0) * overlap + current <= limit:
+        return None
+
+    RATE_LIMITED.labels(route=route).inc()
+    return max(1, int(window - now % window))
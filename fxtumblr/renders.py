@@ -1,13 +1,20 @@
 from .app import app
+from .cache import canonical_blogname
 from .config import config
+from .ratelimit import check_rate_limit
+from .timing import timed
+from .tracing import span
 import fxtumblr_render.paths
 from fxtumblr_render.client import render_thread
 import os.path
 import asyncio
 
-from quart import send_from_directory
+from quart import request, send_from_directory
 
 RENDERS_PATH = config["renders_path"]
+RENDERS_PRERENDER = config.get("renders_prerender", True)
+
+_prerender_tasks = set()
 
 
 @app.route("/renders/<filename>")
@@ -16,26 +23,41 @@ async def get_render(filename: str):
         return "", 404
 
     try:
-        filename = fxtumblr_render.paths.normalize_filename(filename)
+        path_split = fxtumblr_render.paths.from_filename(filename)
     except ValueError:
         return "", 404
+    # Renders are stored under the blog's canonical name
+    path_split["blogname"] = canonical_blogname(path_split["blogname"])
+    filename = fxtumblr_render.paths.filename_for(**path_split)
     path = os.path.join(RENDERS_PATH, filename)
-    path_split = fxtumblr_render.paths.from_filename(filename)
 
+    with span("get_render", filename=filename):
+        return await _get_render(filename, path, path_split)
+
+
+async def _get_render(filename: str, path: str, path_split: dict):
     if (
         not os.path.exists(path)
         or config.get("renders_debug", False)
         or path_split["blogname"] + "-" + str(path_split["post_id"])
         in config.get("renders_ignore_cache", [])
     ):
+        # Only renders that need to be made count towards the limit
+        retry_after = check_rate_limit(
+            "render", request.remote_addr, request.headers.get("User-Agent", "")
+        )
+        if retry_after:
+            return "", 429, {"Retry-After": str(retry_after)}
+
         render_succeeded = False
         try:
             async with asyncio.timeout(12):  # slightly longer than renderer itself
-                render_succeeded = await render_thread(
-                    path_split["blogname"],
-                    path_split["post_id"],
-                    path_split["modifiers"],
-                )
+                with timed("render"):
+                    render_succeeded = await render_thread(
+                        path_split["blogname"],
+                        path_split["post_id"],
+                        path_split["modifiers"],
+                    )
         except TimeoutError:
             render_succeeded = False
 
@@ -43,3 +65,30 @@ async def get_render(filename: str):
             return "", 404
 
     return await send_from_directory(RENDERS_PATH, filename)
+
+
+async def _prerender(blogname: str, postid: int, modifiers: list, post) -> None:
+    try:
+        async with asyncio.timeout(12):
+            with span("prerender", blogname=blogname, post_id=postid):
+                await render_thread(blogname, postid, modifiers, post=post)
+    except Exception:
+        # The render will be retried when the image is actually requested
+        pass
+
+
+def prerender(blogname: str, postid: int, modifiers: list, post) -> None:
+    """
+    Starts rendering a post in the background, so that the render is (likely)
+    ready by the time the client fetches the card's image. The already
+    fetched post is handed to the render server along with the request.
+    """
+    if not RENDERS_PRERENDER:
+        return
+    if os.path.exists(
+        fxtumblr_render.paths.path_to(blogname, postid, "png", modifiers=modifiers)
+    ):
+        return
+    task = asyncio.create_task(_prerender(blogname, postid, modifiers, post))
+    _prerender_tasks.add(task)
+    task.add_done_callback(_prerender_tasks.discard)
@@ -1,16 +1,34 @@
 # SPDX-License-Identifier: MIT
 """
 Statistic counting code.
+
+Hits are counted per 10-minute bucket, combination of modifiers and whether
+the post failed to parse (fxtumblr_stats_rollup); optionally, each hit is
+also saved in a compact form for counting unique posts (fxtumblr_stats_hits).
+Databases from before this can be converted with "statstool.py migrate".
+Unique posts are also counted approximately, in per-day HyperLogLogs in
+valkey (see unique_key).
+
+Hits are collected in an in-memory buffer in each worker and written to the
+database in batches, over a connection that's kept open; call
+start_stats_writer when the app starts and stop_stats_writer when it stops
+(which writes out whatever is still buffered). With stats_stream, the
+batches are added to a valkey stream instead, and written to the database
+by a separate process (see stats_consumer.py).
 """
 
+from .cache import r
 from .config import config
+from .metrics import counter
 
 import asyncio
+import collections
 import datetime
-from typing import List
+from typing import Iterable, List
 import traceback
 import hashlib
-import uuid
+
+import valkey
 
 STATS_DB_TYPE = config.get("stats_db_type", "sqlite")
 if STATS_DB_TYPE == "sqlite":
@@ -33,76 +51,294 @@ elif STATS_DB_TYPE == "postgres":
 else:
     raise ValueError("stats_db_type must be one of: sqlite, postgres")
 STATS_IGNORE = config.get("stats_ignore", [])
-STATS_LOCK = asyncio.Lock()
-TABLE_EXISTS = False
+# Hits are written out every STATS_FLUSH_INTERVAL seconds, or as soon as
+# STATS_FLUSH_ROWS of them are waiting; at most STATS_BUFFER_SIZE are kept.
+STATS_FLUSH_INTERVAL = float(config.get("stats_flush_interval", 5))
+STATS_FLUSH_ROWS = int(config.get("stats_flush_rows", 500))
+STATS_BUFFER_SIZE = int(config.get("stats_buffer_size", 10000))
+# Whether to save each hit (needed for counting unique posts), on top of
+# the per-bucket counts
+STATS_RAW_HITS = config.get("stats_raw_hits", True)
+# Whether to count unique posts per day in valkey, and for how many days
+STATS_UNIQUE_HLL = config.get("stats_unique_hll", True)
+STATS_UNIQUE_RETENTION = int(config.get("stats_unique_retention_days", 400))
+# Whether to pass hits on to the stats consumer through a valkey stream,
+# instead of writing them to the database from the web workers
+STATS_STREAM = config.get("stats_stream", False)
+STATS_STREAM_KEY = "fxtumblr-stats"
+# Roughly how many hits the stream holds; if the consumer falls this far
+# behind, the oldest hits are lost
+STATS_STREAM_MAXLEN = int(config.get("stats_stream_maxlen", 1000000))
+
+STATS_DROPPED = counter(
+    "fxtumblr_stats_dropped_total",
+    "Hits that were not saved, by reason (overflow, error)",
+    ("reason",),
+)
+
+# Modifiers are stored as a bitmask; each one gets the bit at its index
+STATS_MODIFIERS = ("unroll", "dark", "oldstyle")
+
+STATS_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS fxtumblr_stats_rollup(
+    time INTEGER NOT NULL,
+    modifiers INTEGER NOT NULL,
+    failed BOOLEAN NOT NULL,
+    hits BIGINT NOT NULL,
+    PRIMARY KEY (time, modifiers, failed)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS fxtumblr_stats_hits(
+    time INTEGER NOT NULL,
+    post BIGINT NOT NULL,
+    modifiers INTEGER NOT NULL,
+    failed BOOLEAN NOT NULL
+    );
+    """,
+    # Covers the queries for unique posts in statstool
+    """
+    CREATE INDEX IF NOT EXISTS fxtumblr_stats_hits_time
+    ON fxtumblr_stats_hits (time, modifiers, post);
+    """,
+)
+
+# Adds to the existing count for the bucket, if any
+ROLLUP_UPSERT = (
+    "INSERT INTO fxtumblr_stats_rollup (time, modifiers, failed, hits)"
+    " VALUES ({0}, {0}, {0}, {0}) ON CONFLICT (time, modifiers, failed)"
+    " DO UPDATE SET hits = fxtumblr_stats_rollup.hits + excluded.hits;"
+)
+HITS_COLUMNS = "(time, post, modifiers, failed)"
+
+
+def hash_post(blogname: str, postid: str) -> int:
+    """Returns a 64-bit hash of the post, for counting unique posts."""
+    digest = hashlib.sha256(str.encode(f"{blogname}-{postid}")).digest()
+    return int.from_bytes(digest[:8], "big", signed=True)
+
+
+def modifiers_mask(modifiers: Iterable[str]) -> int:
+    """Returns the bitmask for the given modifiers; unknown ones are ignored."""
+    mask = 0
+    for i, mod in enumerate(STATS_MODIFIERS):
+        if mod in modifiers:
+            mask |= 1 << i
+    return mask
+
+
+def unique_key(date: datetime.date, mask: int) -> str:
+    """
+    Returns the key of the HyperLogLog of posts hit on the given (local)
+    day with the given modifiers.
+    """
+    return f"fxtumblr-stats-unique:{date.isoformat()}:{mask}"
+
+
+def add_unique_posts(rows: Iterable[tuple]) -> None:
+    """Adds the posts from (time, post, modifiers, failed) rows to the HLLs."""
+    posts = collections.defaultdict(set)
+    for time, post, mods, _ in rows:
+        posts[unique_key(datetime.date.fromtimestamp(time), mods)].add(post)
+
+    pipe = r.pipeline(transaction=False)
+    for key, key_posts in posts.items():
+        pipe.pfadd(key, *key_posts)
+        pipe.expire(key, STATS_UNIQUE_RETENTION * 24 * 60 * 60)
+    pipe.execute()
+
+
+def add_to_stream(rows: Iterable[tuple]) -> None:
+    """Adds (time, post, modifiers, failed) rows to the stats stream."""
+    pipe = r.pipeline(transaction=False)
+    for time, post, mods, failed in rows:
+        pipe.xadd(
+            STATS_STREAM_KEY,
+            {"time": time, "post": post, "modifiers": mods, "failed": int(failed)},
+            maxlen=STATS_STREAM_MAXLEN,
+            approximate=True,
+        )
+    pipe.execute()
+
+
+def row_from_stream(fields: dict) -> tuple:
+    """Returns the (time, post, modifiers, failed) row from a stream entry."""
+    return (
+        int(fields[b"time"]),
+        int(fields[b"post"]),
+        int(fields[b"modifiers"]),
+        fields[b"failed"] == b"1",
+    )
 
 
-def hash_post(blogname: str, postid: str):
-    return hashlib.sha256(str.encode(f"{blogname}-{postid}")).hexdigest()
+def rollup(rows: Iterable[tuple]) -> List[tuple]:
+    """
+    Sums up hits, given as (time, post, modifiers, failed) rows, into
+    (time, modifiers, failed, hits) rows for fxtumblr_stats_rollup.
+    """
+    counts = collections.Counter((time, mods, failed) for time, _, mods, failed in rows)
+    return [(*key, hits) for key, hits in counts.items()]
+
+
+class StatsWriter:
+    """Buffers hits and writes them to the stats database in batches."""
+
+    def __init__(self, buffer_size: int, flush_rows: int, flush_interval: float):
+        self.buffer = collections.deque(maxlen=buffer_size)
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.conn = None
+        self.task = None
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+
+    def add(self, row: tuple) -> None:
+        if len(self.buffer) == self.buffer.maxlen:
+            # The oldest hit is pushed out of the buffer
+            STATS_DROPPED.labels(reason="overflow").inc()
+        self.buffer.append(row)
+        if len(self.buffer) >= self.flush_rows:
+            self._wakeup.set()
+
+    def start(self) -> None:
+        if self.task is None:
+            self._stopping = False
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            # Let the flush loop finish, rather than interrupting a write
+            self._stopping = True
+            self._wakeup.set()
+            await self.task
+            self.task = None
+        await self.flush()
+        await self.close()
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Writes all buffered hits to the database."""
+        async with self._lock:
+            if not self.buffer:
+                return
+            rows = list(self.buffer)
+            self.buffer.clear()
+            try:
+                if STATS_STREAM:
+                    await asyncio.to_thread(add_to_stream, rows)
+                else:
+                    await self.save(rows)
+            except Exception:
+                traceback.print_exc()
+                STATS_DROPPED.labels(reason="error").inc(len(rows))
+                # Reconnect on the next flush, in case the connection broke
+                await self.close()
+
+    async def _connect(self):
+        if self.conn is None:
+            if STATS_DB_TYPE == "sqlite":
+                conn = await aiosqlite.connect(STATS_DB, timeout=30)
+            elif STATS_DB_TYPE == "postgres":
+                conn = await psycopg.AsyncConnection.connect(PSQL_DSN)
+            try:
+                await setup_db(conn)
+                await conn.commit()
+            except BaseException:
+                await conn.close()
+                raise
+            self.conn = conn
+        return self.conn
 
+    async def close(self) -> None:
+        if self.conn is not None:
+            conn, self.conn = self.conn, None
+            try:
+                await conn.close()
+            except Exception:
+                pass
 
-async def register_hit(
+    async def save(self, rows: List[tuple]) -> None:
+        """
+        Saves (time, post, modifiers, failed) rows to the database and adds
+        the posts to the unique post counts. Raises an exception if the rows
+        couldn't be saved.
+        """
+        if STATS_UNIQUE_HLL:
+            try:
+                await asyncio.to_thread(add_unique_posts, rows)
+            except valkey.exceptions.ValkeyError:
+                traceback.print_exc()
+        await self._write(rows)
+
+    async def _write(self, rows: List[tuple]) -> None:
+        conn = await self._connect()
+        if STATS_DB_TYPE == "sqlite":
+            await conn.executemany(ROLLUP_UPSERT.format("?"), rollup(rows))
+            if STATS_RAW_HITS:
+                await conn.executemany(
+                    f"INSERT INTO fxtumblr_stats_hits {HITS_COLUMNS}"
+                    " VALUES (?, ?, ?, ?);",
+                    rows,
+                )
+            await conn.commit()
+        elif STATS_DB_TYPE == "postgres":
+            async with conn.cursor() as acur:
+                await acur.executemany(ROLLUP_UPSERT.format("%s"), rollup(rows))
+                if STATS_RAW_HITS:
+                    async with acur.copy(
+                        f"COPY fxtumblr_stats_hits {HITS_COLUMNS} FROM STDIN"
+                    ) as copy:
+                        for row in rows:
+                            await copy.write_row(row)
+            await conn.commit()
+
+
+writer = StatsWriter(STATS_BUFFER_SIZE, STATS_FLUSH_ROWS, STATS_FLUSH_INTERVAL)
+
+
+def register_hit(
     blogname: str, postid: str, modifiers: List[str] = (), failed: bool = False
 ):
+    """Adds a hit to the buffer; it's saved on the next flush."""
     if f"{blogname}-{postid}" in STATS_IGNORE:
         return
-    async with STATS_LOCK:
-        now = datetime.datetime.now()
-        # Round time down to closest 10 minutes
-        now = now.replace(minute=((now.minute // 10) * 10), second=0)
-
-        data = {
-            "id": str(uuid.uuid4()),
-            "time": int(now.timestamp()),
-            "post": hash_post(blogname, postid),
-            "modifiers": ",".join(modifiers) if modifiers else "",
-            "failed": failed,
-        }
-
-        try:
-            if STATS_DB_TYPE == "sqlite":
-                async with aiosqlite.connect(STATS_DB) as db:
-                    await setup_db(db)
-                    await db.execute(
-                        "INSERT INTO fxtumblr_stats (id, time, post, modifiers, failed) VALUES (:id, :time, :post, :modifiers, :failed);",
-                        data,
-                    )
-                    await db.commit()
-            elif STATS_DB_TYPE == "postgres":
-                async with await psycopg.AsyncConnection.connect(PSQL_DSN) as aconn:
-                    async with aconn.cursor() as acur:
-                        await setup_db(acur)
-                        await acur.execute(
-                            "INSERT INTO fxtumblr_stats (id, time, post, modifiers, failed) VALUES (%s, %s, %s, %s, %s);",
-                            (
-                                data["id"],
-                                data["time"],
-                                data["post"],
-                                data["modifiers"],
-                                data["failed"],
-                            ),
-                        )
-                    await aconn.commit()
-        except:
-            traceback.print_exc()
+    now = datetime.datetime.now()
+    # Round time down to closest 10 minutes
+    now = now.replace(minute=((now.minute // 10) * 10), second=0)
+
+    writer.add(
+        (
+            int(now.timestamp()),
+            hash_post(blogname, postid),
+            modifiers_mask(modifiers),
+            failed,
+        )
+    )
+
+
+def start_stats_writer() -> None:
+    """Starts flushing buffered hits in the background."""
+    writer.start()
+
+
+async def stop_stats_writer() -> None:
+    """Stops the background flush and writes out any remaining hits."""
+    await writer.stop()
 
 
 async def setup_db(db):
     """
     Sets up the database for statistics.
     """
-    global TABLE_EXISTS
-
-    # Check if fxtumblr_stats table exists
-    if not TABLE_EXISTS:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS fxtumblr_stats(
-            id VARCHAR(48) PRIMARY KEY,
-            time INTEGER,
-            post VARCHAR(256),
-            modifiers TEXT,
-            failed BOOLEAN
-            );
-            """)
-
-        TABLE_EXISTS = True
+    for statement in STATS_SCHEMA:
+        await db.execute(statement)
@@ -0,0 +1,136 @@
+# SPDX-License-Identifier: MIT
+"""
+Writes statistics from the valkey stream (see stats_stream in the config)
+to the database. Run with "python3 -m fxtumblr.stats_consumer".
+
+Hits are read through a consumer group and only acknowledged once they've
+been committed, so if the consumer crashes, they're written once it comes
+back (or by another consumer, which claims them after a while). A hit may
+be counted twice if the consumer crashes between a commit and the
+acknowledgement.
+"""
+
+import asyncio
+import signal
+import socket
+import traceback
+
+import valkey
+
+from .cache import r
+from .config import config
+from .stats import (
+    STATS_BUFFER_SIZE,
+    STATS_FLUSH_INTERVAL,
+    STATS_FLUSH_ROWS,
+    STATS_STREAM_KEY,
+    StatsWriter,
+    row_from_stream,
+)
+
+STATS_STREAM_GROUP = "fxtumblr-stats-writers"
+STATS_CONSUMER_NAME = config.get("stats_consumer_name", socket.gethostname())
+# How long a hit can be left unacknowledged by another consumer before it's
+# taken over, in seconds
+STATS_CLAIM_IDLE = float(config.get("stats_stream_claim_idle", 60))
+STATS_RETRY_DELAY = 5
+
+
+class StatsConsumer:
+    """Reads hits from the stats stream and saves them to the database."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.writer = StatsWriter(
+            STATS_BUFFER_SIZE, STATS_FLUSH_ROWS, STATS_FLUSH_INTERVAL
+        )
+        self.stopping = False
+        # Whether to go through our own unacknowledged entries before new ones
+        self.pending = True
+        self.claim_cursor = "0-0"
+
+    def stop(self) -> None:
+        self.stopping = True
+
+    def _create_group(self) -> None:
+        try:
+            r.xgroup_create(
+                STATS_STREAM_KEY, STATS_STREAM_GROUP, id="0", mkstream=True
+            )
+        except valkey.exceptions.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def _claim(self) -> None:
+        """Takes over entries that other consumers left unacknowledged."""
+        self.claim_cursor, claimed, *_ = r.xautoclaim(
+            STATS_STREAM_KEY,
+            STATS_STREAM_GROUP,
+            self.name,
+            int(STATS_CLAIM_IDLE * 1000),
+            start_id=self.claim_cursor,
+            count=STATS_FLUSH_ROWS,
+        )
+        if claimed:
+            print(f"Claimed {len(claimed)} unacknowledged hits")
+            self.pending = True
+
+    def _read(self) -> list:
+        streams = r.xreadgroup(
+            STATS_STREAM_GROUP,
+            self.name,
+            {STATS_STREAM_KEY: "0" if self.pending else ">"},
+            count=STATS_FLUSH_ROWS,
+            block=None if self.pending else int(STATS_FLUSH_INTERVAL * 1000),
+        )
+        return streams[0][1] if streams else []
+
+    async def _process(self, entries: list) -> None:
+        ids = []
+        rows = []
+        for entry_id, fields in entries:
+            ids.append(entry_id)
+            # Entries that were trimmed from the stream have no fields
+            if not fields:
+                continue
+            try:
+                rows.append(row_from_stream(fields))
+            except (KeyError, ValueError):
+                print(f"Skipping malformed hit {entry_id}: {fields}")
+
+        if rows:
+            await self.writer.save(rows)
+        await asyncio.to_thread(r.xack, STATS_STREAM_KEY, STATS_STREAM_GROUP, *ids)
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+
+        await asyncio.to_thread(self._create_group)
+        last_claim = 0
+        while not self.stopping:
+            try:
+                if loop.time() - last_claim >= STATS_CLAIM_IDLE:
+                    await asyncio.to_thread(self._claim)
+                    last_claim = loop.time()
+
+                entries = await asyncio.to_thread(self._read)
+                if not entries:
+                    # Nothing left from before, carry on with new entries
+                    self.pending = False
+                    continue
+                await self._process(entries)
+            except Exception:
+                traceback.print_exc()
+                await self.writer.close()
+                # Unsaved entries stay pending, so they're retried
+                self.pending = True
+                await asyncio.sleep(STATS_RETRY_DELAY)
+
+        await self.writer.close()
+
+
+if __name__ == "__main__":
+    print(f"Consuming statistics from {STATS_STREAM_KEY} as {STATS_CONSUMER_NAME}")
+    asyncio.run(StatsConsumer(STATS_CONSUMER_NAME).run())
@@ -0,0 +1,69 @@
+"""
+Lightweight per-request stage timers.
+
+Timings are collected for the current request (in a context variable) and
+sent back in a Server-Timing header; requests slower than the configured
+threshold are also logged with the full breakdown. Outside of a request
+(e.g. in the render server), timers do nothing.
+"""
+
+import contextvars
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from .config import config
+
+SERVER_TIMING = config.get("server_timing", True)
+# In milliseconds; 0 disables the slow request log
+SLOW_REQUEST_THRESHOLD = float(config.get("slow_request_threshold", 0))
+
+_timings: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar(
+    "fxtumblr_timings", default=None
+)
+
+
+def start_timings() -> Dict[str, float]:
+    """Starts collecting timings in the current context."""
+    timings = {}
+    _timings.set(timings)
+    return timings
+
+
+def get_timings() -> Optional[Dict[str, float]]:
+    """Returns the timings collected in the current context, if any."""
+    return _timings.get()
+
+
+def add_timings(timings: Dict[str, float]) -> None:
+    """Adds timings collected elsewhere (e.g. in a worker process)."""
+    current = _timings.get()
+    if current is None:
+        return
+    for stage, duration in timings.items():
+        current[stage] = current.get(stage, 0) + duration
+
+
+@contextmanager
+def timed(stage: str):
+    """Adds the time spent in the block to the given stage (in ms)."""
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = (
+            timings.get(stage, 0) + (time.perf_counter() - start) * 1000
+        )
+
+
+def server_timing_header(timings: Dict[str, float], total: float) -> str:
+    """Formats timings as a Server-Timing header value."""
+    return ", ".join(
+        f"{stage};dur={duration:.1f}"
+        for stage, duration in (*timings.items(), ("total", total))
+    )
@@ -0,0 +1,289 @@
+"""
+Minimal distributed tracing, used to follow requests from the web app
+through the render client and the render server.
+
+Trace context is passed between processes as a W3C traceparent string
+(see https://www.w3.org/TR/trace-context/). Finished spans are exported
+in the background, either as JSON lines to a file or as OTLP/HTTP JSON to
+a local collector (e.g. the OpenTelemetry Collector or Jaeger).
+"""
+
+import contextvars
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+import requests
+
+from .config import config
+from .jsoncodec import dumps
+
+TRACING_ENABLED = config.get("tracing", False)
+TRACING_EXPORTER = config.get("tracing_exporter", "json")
+TRACING_FILE = config.get("tracing_file", "traces.jsonl")
+TRACING_ENDPOINT = config.get("tracing_endpoint", "http://localhost:4318/v1/traces")
+TRACING_SAMPLE_RATE = float(config.get("tracing_sample_rate", 1.0))
+
+#: Name of the service that spans are recorded for; changed by the render server.
+service_name = "fxtumblr"
+
+
+class Span:
+    """A single timed operation in a trace."""
+
+    __slots__ = (
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "name",
+        "start_ns",
+        "end_ns",
+        "attributes",
+        "error",
+        "service",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        trace_id: str,
+        parent_id: Optional[str] = None,
+        attributes: Optional[Dict[str, Any]] = None,
+        start_ns: Optional[int] = None,
+    ):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes or {}
+        self.error = None
+        self.service = service_name
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def end(self, end_ns: Optional[int] = None) -> None:
+        self.end_ns = end_ns or time.time_ns()
+        _exporter.export(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "service": self.service,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": (self.end_ns - self.start_ns) / 1_000_000,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class _RemoteParent:
+    """Parent span from another process, as parsed from a traceparent."""
+
+    __slots__ = ("trace_id", "span_id")
+
+    def __init__(self, trace_id: str, span_id: str):
+        self.trace_id = trace_id
+        self.span_id = span_id
+
+
+# The current span, or a remote parent, or False if the current trace is
+# not sampled
+_current: contextvars.ContextVar = contextvars.ContextVar(
+    "fxtumblr_span", default=None
+)
+
+
+def _parse_traceparent(traceparent: Optional[str]):
+    try:
+        version, trace_id, span_id, flags = traceparent.split("-")
+        int(trace_id, 16), int(span_id, 16)
+    except (AttributeError, ValueError):
+        return None
+    if len(trace_id) != 32 or len(span_id) != 16:
+        return None
+    if not int(flags, 16) & 1:
+        return False
+    return _RemoteParent(trace_id, span_id)
+
+
+@contextmanager
+def continue_trace(traceparent: Optional[str]):
+    """Makes spans in the block children of the given (remote) span."""
+    if not TRACING_ENABLED:
+        yield
+        return
+
+    token = _current.set(_parse_traceparent(traceparent))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def _new_span(name: str, start_ns: Optional[int], attributes: dict) -> Optional[Span]:
+    parent = _current.get()
+    if parent is False:
+        return None
+    if parent is None:
+        if random.random() >= TRACING_SAMPLE_RATE:
+            return None
+        return Span(name, os.urandom(16).hex(), None, attributes, start_ns)
+    return Span(name, parent.trace_id, parent.span_id, attributes, start_ns)
+
+
+def start_span(
+    name: str, start_ns: Optional[int] = None, **attributes
+) -> Optional[Span]:
+    """
+    Starts a span as a child of the current span (or a new trace), without
+    making it the current span. The caller must call end() on it. Returns
+    None if tracing is disabled or the trace isn't sampled.
+    """
+    if not TRACING_ENABLED:
+        return None
+    return _new_span(name, start_ns, attributes)
+
+
+@contextmanager
+def span(name: str, start_ns: Optional[int] = None, **attributes):
+    """
+    Records the block as a span, which is the current span inside it.
+    start_ns can be used to start the span before the block (e.g. when
+    the request was received).
+    """
+    if not TRACING_ENABLED:
+        yield None
+        return
+
+    s = _new_span(name, start_ns, attributes)
+    # If the trace isn't sampled, mark it so that nested spans are skipped too
+    token = _current.set(s if s is not None else False)
+    try:
+        yield s
+    except BaseException as e:
+        if s is not None:
+            s.error = repr(e)
+        raise
+    finally:
+        _current.reset(token)
+        if s is not None:
+            s.end()
+
+
+def current_traceparent() -> Optional[str]:
+    """Returns the traceparent to pass on to other processes, if any."""
+    current = _current.get()
+    if not current:
+        return None
+    if isinstance(current, Span):
+        return current.traceparent
+    return f"00-{current.trace_id}-{current.span_id}-01"
+
+
+def _otlp_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _to_otlp(spans: List[Span]) -> dict:
+    by_service = {}
+    for s in spans:
+        by_service.setdefault(s.service, []).append(
+            {
+                "traceId": s.trace_id,
+                "spanId": s.span_id,
+                "parentSpanId": s.parent_id or "",
+                "name": s.name,
+                "kind": 1,
+                "startTimeUnixNano": str(s.start_ns),
+                "endTimeUnixNano": str(s.end_ns),
+                "attributes": [
+                    {"key": k, "value": _otlp_value(v)}
+                    for k, v in s.attributes.items()
+                ],
+                "status": {"code": 2, "message": s.error} if s.error else {},
+            }
+        )
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": [
+                        {"key": "service.name", "value": {"stringValue": service}}
+                    ]
+                },
+                "scopeSpans": [{"scope": {"name": "fxtumblr"}, "spans": otlp_spans}],
+            }
+            for service, otlp_spans in by_service.items()
+        ]
+    }
+
+
+class _SpanExporter:
+    """Exports finished spans in batches from a background thread."""
+
+    BATCH_SIZE = 256
+    INTERVAL = 2
+
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+
+    def export(self, s: Span) -> None:
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self._run, name="fxtumblr-tracing", daemon=True
+            )
+            self.thread.start()
+        self.queue.put(s)
+
+    def _run(self) -> None:
+        while True:
+            spans = [self.queue.get()]
+            deadline = time.monotonic() + self.INTERVAL
+            while len(spans) < self.BATCH_SIZE:
+                try:
+                    spans.append(
+                        self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                    )
+                except queue.Empty:
+                    break
+            try:
+                self._write(spans)
+            except Exception as e:
+                print(f"Failed to export {len(spans)} spans: {e}")
+
+    def _write(self, spans: List[Span]) -> None:
+        if TRACING_EXPORTER == "otlp":
+            requests.post(
+                TRACING_ENDPOINT,
+                data=dumps(_to_otlp(spans)),
+                headers={"Content-Type": "application/json"},
+                timeout=5,
+            )
+        else:
+            with open(TRACING_FILE, "ab") as f:
+                f.write(b"".join(dumps(s.to_dict()) + b"\n" for s in spans))
+
+
+_exporter = _SpanExporter()
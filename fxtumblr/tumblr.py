@@ -12,7 +12,11 @@ from requests.exceptions import TooManyRedirects, HTTPError
 import sys
 
 from .cache import (
+    canonical_blogname,
+    record_blog_alias,
+    forget_blog_alias,
     post_needs_caching,
+    post_is_cached,
     cache_post,
     get_cached_post,
     poll_needs_caching,
@@ -23,8 +27,12 @@ from .cache import (
     avatar_needs_caching,
 )
 from .config import config
+from .jsoncodec import loads
+from .metrics import CACHE_LOOKUPS, TUMBLR_API_CALLS, TUMBLR_API_RATE_LIMITED
+from .npf_schema import decode_posts_response, to_builtins
+from .timing import timed
 
-from typing import List
+from typing import List, Optional
 
 # needed by FxTumblrRequest
 PY3 = True
@@ -91,6 +99,13 @@ class FxTumblrRequest:
 
         return True
 
+    def _record_response(self, status_code: int) -> None:
+        """Records an API call made with the current key in the metrics."""
+        key = str(self.current_cred)
+        TUMBLR_API_CALLS.labels(key=key).inc()
+        if status_code == 429:
+            TUMBLR_API_RATE_LIMITED.labels(key=key).inc()
+
     ### TumblrRequest code start ###
 
     def get(self, url, params):
@@ -135,6 +150,7 @@ class FxTumblrRequest:
             }
 
         # FxTumblrRequest modification start
+        self._record_response(resp.status_code)
         if resp.status_code == 429:
             if self.next_key():
                 return self.get(_url, params)
@@ -171,6 +187,7 @@ class FxTumblrRequest:
                 )
 
                 # FxTumblrRequest modification start
+                self._record_response(resp.status_code)
                 if resp.status_code == 429:
                     if self.next_key():
                         return self.post(_url, params, files)
@@ -181,6 +198,7 @@ class FxTumblrRequest:
                 return self.json_parse(resp)
         except HTTPError as e:
             # FxTumblrRequest modification start
+            self._record_response(e.response.status_code)
             if e.response.status_code == 429:
                 if self.next_key():
                     return self.post(_url, params, files)
@@ -212,6 +230,7 @@ class FxTumblrRequest:
             resp = e.response
 
         # FxTumblrRequest modification start
+        self._record_response(resp.status_code)
         if resp.status_code == 429:
             if self.next_key():
                 return self.delete(_url, params)
@@ -224,13 +243,18 @@ class FxTumblrRequest:
     ### TumblrRequest code end ###
 
     def json_parse(self, response):
+        """
+        Same as pytumblr.request.TumblrRequest.json_parse, but decodes the
+        response body only once, using our JSON codec.
+        """
+        data = None
         if response is None:
             print(
                 "Error when parsing Tumblr JSON response: no response", file=sys.stderr
             )
         else:
             try:
-                response.json()
+                data = loads(response.content)
             except ValueError:
                 try:
                     print(
@@ -243,7 +267,18 @@ class FxTumblrRequest:
                         file=sys.stderr,
                     )
 
-        return TumblrRequest.json_parse(self, response)
+        if not isinstance(data, dict) or "meta" not in data:
+            data = {
+                "meta": {"status": 500, "msg": "Server Error"},
+                "response": {"error": "Malformed JSON or HTML was returned."},
+            }
+
+        # We only really care about the response if we succeed
+        # and the error if we fail
+        if 200 <= data["meta"]["status"] <= 399:
+            return data["response"]
+        else:
+            return data
 
     def post_multipart(self, url, params, files):
         return TumblrRequest.post_multipart(self, url, params, files)
@@ -268,36 +303,85 @@ else:
 DEFAULT_AVATAR = "https://assets.tumblr.com/pop/src/assets/images/avatar/anonymous_avatar_40-3af33dc0.png"
 
 
-def get_post(blogname: str, postid: str):
-    needs_caching = post_needs_caching(blogname, postid)
-    post = None
+def _fetch_post(blogname: str, postid: str):
+    """Fetches a post from Tumblr; returns the response, or an error."""
+    with timed("tumblr"):
+        _post = tumblr.posts(blogname=blogname, id=postid, reblog_info=True, npf=True)
+    if not _post or "posts" not in _post or not _post["posts"]:
+        if "error" not in _post:
+            _post["error"] = True
+    return _post
+
+
+def get_post(
+    blogname: str,
+    postid: str,
+    stale_ok: bool = False,
+    canonical: Optional[str] = None,
+    needs_caching: Optional[bool] = None,
+):
+    """
+    Gets a post, from the cache if possible. If stale_ok is set, an expired
+    cached post is returned instead of fetching it again.
+
+    The blog name may be an alias (see canonical_blogname); the post is
+    always cached under the blog's canonical name. Callers that have
+    already looked up the canonical name and whether the post needs to be
+    fetched (e.g. admission control) can pass them in.
+    """
+    with timed("cache"):
+        if canonical is None:
+            canonical = canonical_blogname(blogname)
+        if needs_caching is None:
+            needs_caching = post_needs_caching(canonical, postid)
+            if needs_caching and stale_ok and post_is_cached(canonical, postid):
+                needs_caching = False
+    CACHE_LOOKUPS.labels(kind="post", result="miss" if needs_caching else "hit").inc()
 
     if needs_caching:
-        _post = tumblr.posts(blogname=blogname, id=postid, reblog_info=True, npf=True)
-        if not _post or "posts" not in _post or not _post["posts"]:
-            if "error" not in _post:
-                _post["error"] = True
+        _post = _fetch_post(canonical, postid)
+        if "error" in _post and canonical != blogname.lower():
+            # The alias may be stale (e.g. the blog was renamed and someone
+            # else took its old name); try the name from the URL instead
+            retry = _fetch_post(blogname, postid)
+            if "error" not in retry:
+                with timed("cache"):
+                    forget_blog_alias(blogname)
+                _post = retry
+        if "error" in _post:
             return _post
 
         try:
-            blogname = _post["blog"]["name"]
+            canonical = _post["blog"]["name"]
         except KeyError:
-            blogname = _post["broken_blog_name"]
+            canonical = _post["broken_blog_name"]
 
-        post = _post["posts"][0]
-        cache_post(blogname, postid, _post)
+        # Decode the response from what we cache, so that the result is the
+        # same as for cached posts (typed structs, if available)
+        with timed("cache"):
+            record_blog_alias(blogname, canonical)
+            _post = decode_posts_response(cache_post(canonical, postid, _post))
     else:
-        _post = get_cached_post(blogname, postid)
-        post = _post["posts"][0]
-    if "blog" in _post:
-        post["_fx_author_blog"] = _post["blog"]
+        with timed("cache"):
+            _post = get_cached_post(canonical, postid)
+
+    return post_from_response(_post)
+
 
+def post_from_response(response):
+    """Returns the post from a (cached) response from the posts endpoint."""
+    post = response["posts"][0]
+    if "blog" in response:
+        post["_fx_author_blog"] = response["blog"]
     return post
 
 
 def get_poll(blog_name: str, post_id: str, poll_id: str, block: dict):
     """Gets data about a poll from Tumblr's API. Note that this API is undocumented and subject to change; it's also missing most of the useful information, so we need to merge it with the block data."""
     needs_caching = poll_needs_caching(blog_name, int(post_id), poll_id)
+    CACHE_LOOKUPS.labels(
+        kind="poll", result="miss" if needs_caching else "hit"
+    ).inc()
 
     poll = None
 
@@ -311,7 +395,7 @@ def get_poll(blog_name: str, post_id: str, poll_id: str, block: dict):
         except:
             return None
 
-        poll = poll | block
+        poll = poll | to_builtins(block)
         cache_poll(blog_name, post_id, poll)
     else:
         poll = get_cached_poll(blog_name, post_id, poll_id)
@@ -322,6 +406,9 @@ def get_poll(blog_name: str, post_id: str, poll_id: str, block: dict):
 def get_avatar(blog_name: str):
     """Gets the URL of the avatar for the post from Tumblr's API."""
     needs_caching = avatar_needs_caching(blog_name)
+    CACHE_LOOKUPS.labels(
+        kind="avatar", result="miss" if needs_caching else "hit"
+    ).inc()
 
     avatar_url = None
     if needs_caching:
@@ -0,0 +1,54 @@
+"""
+Contains code for telling link preview crawlers apart from regular browsers.
+"""
+
+import functools
+import re
+
+from .config import config
+
+# User agents of link preview crawlers (chat apps, social media, search
+# engines). Some of these also contain "Mozilla/", so this is checked first.
+CRAWLER_USER_AGENTS = [
+    "Discordbot",
+    "Twitterbot",
+    "TelegramBot",
+    "Slackbot",
+    "facebookexternalhit",
+    "Facebot",
+    "Mastodon",
+    "Pleroma",
+    "Akkoma",
+    "Misskey",
+    "Bluesky",
+    "Cardyb",
+    "WhatsApp",
+    "SkypeUriPreview",
+    "redditbot",
+    "LinkedInBot",
+    "vkShare",
+    "Iframely",
+    "Embedly",
+    "Synapse",
+    "matrix",
+    "Revolt",
+    "Googlebot",
+    "bingbot",
+    "Applebot",
+] + config.get("crawler_user_agents", [])
+
+_crawler_re = re.compile(
+    "|".join(re.escape(ua) for ua in CRAWLER_USER_AGENTS), re.IGNORECASE
+)
+
+
+@functools.lru_cache(maxsize=1024)
+def is_browser(user_agent: str) -> bool:
+    """
+    Returns True if the user agent belongs to a regular web browser, i.e.
+    a human visitor. Anything unknown is assumed to be a crawler, so that
+    it gets a proper embed.
+    """
+    if not user_agent or "Mozilla/" not in user_agent:
+        return False
+    return not _crawler_re.search(user_agent)
@@ -1,72 +1,87 @@
 import asyncio
-import json
 import traceback
 import os.path
-from typing import Optional
+from typing import Any, Optional
 
 from fxtumblr.config import config
+from fxtumblr.jsoncodec import loads, dumps
+from fxtumblr.tracing import current_traceparent, span
 from .paths import path_to
 
+RENDERS_MAX_MESSAGE_SIZE = int(config.get("renders_max_message_size", 16 * 1024 * 1024))
+
 _queue = set()
 
 
 async def render_thread(
-    blogname: str, post_id: int, modifiers: Optional[list[str]] = None
+    blogname: str,
+    post_id: int,
+    modifiers: Optional[list[str]] = None,
+    post: Optional[Any] = None,
 ) -> bool:
-    global _queue
-
-    reader, writer = await asyncio.open_connection(
-        config.get("renders_host", "localhost"), int(config.get("renders_port", 6500))
-    )
+    """
+    Asks the render server to render a post. If the post has already been
+    fetched, it can be passed in post, so that the render server doesn't
+    need to fetch it again.
 
+    Messages are sent as single lines of JSON.
+    """
     work_id = f"{blogname}-{post_id}"
     if modifiers:
         work_id += f".{','.join(sorted(modifiers))}"
-    if work_id not in _queue:
-        _queue.add(work_id)
-
-        to_send = {
-            "blogname": blogname,
-            "post_id": post_id,
-            "modifiers": modifiers or [],
-            "work_id": work_id,
-        }
+    with span("render_client", work_id=work_id):
+        if work_id in _queue:
+            # Already being rendered; wait for that render to finish
+            while work_id in _queue:
+                await asyncio.sleep(0.5)
+            return os.path.exists(
+                path_to(blogname, post_id, extension="png", modifiers=modifiers)
+            )
 
+        # The work ID must leave the queue even if this is cancelled (e.g. by
+        # a timeout), or later renders of the post would wait on it forever
+        _queue.add(work_id)
+        writer = None
         try:
-            writer.write(bytes(json.dumps(to_send), "utf-8"))
-            await writer.drain()
-        except:
-            print("Error on render sendoff!")
-            traceback.print_exc()
-            _queue.remove(work_id)
-            return False
+            reader, writer = await asyncio.open_connection(
+                config.get("renders_host", "localhost"),
+                int(config.get("renders_port", 6500)),
+                limit=RENDERS_MAX_MESSAGE_SIZE,
+            )
+
+            to_send = {
+                "blogname": blogname,
+                "post_id": post_id,
+                "modifiers": modifiers or [],
+                "work_id": work_id,
+            }
+            if post is not None:
+                to_send["post"] = post
+            traceparent = current_traceparent()
+            if traceparent:
+                to_send["traceparent"] = traceparent
 
-        while True:
-            data = await reader.read(1024)
             try:
-                data = json.loads(data.decode())
-                if data["work_id"] == work_id:
-                    break
-            except (ValueError, KeyError, json.decoder.JSONDecodeError):
+                writer.write(dumps(to_send) + b"\n")
+                await writer.drain()
+            except:
+                print("Error on render sendoff!")
                 traceback.print_exc()
-                continue
-
-        _queue.remove(work_id)
-    else:
-        while True:
-            await asyncio.sleep(0.5)
-            if work_id not in _queue:
-                break
-        data = {
-            "work_id": work_id,
-            "return": os.path.exists(
-                path_to(blogname, post_id, extension="png", modifiers=modifiers)
-            ),
-        }
-
-    response = data.get("return", False)
-
-    writer.close()
-    await writer.wait_closed()
+                return False
 
-    return response
+            while True:
+                data = await reader.readline()
+                if not data:
+                    # Render server closed the connection
+                    return False
+                try:
+                    data = loads(data)
+                    if data["work_id"] == work_id:
+                        return data.get("return", False)
+                except (ValueError, KeyError):
+                    traceback.print_exc()
+                    continue
+        finally:
+            _queue.discard(work_id)
+            if writer is not None:
+                writer.close()
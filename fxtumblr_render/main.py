@@ -1,12 +1,25 @@
 import asyncio
-import json
+import os.path
+import time
 import traceback
 from contextlib import suppress
 
 from fxtumblr.config import config
+from fxtumblr.metrics import (
+    RENDER_DURATION,
+    RENDER_FILE_SIZE,
+    RENDER_QUEUE_DEPTH,
+    RENDER_WORKER_BUSY,
+    start_metrics_server,
+)
+from fxtumblr.jsoncodec import loads, dumps
 from fxtumblr.tumblr import get_post
 from fxtumblr.npf import TumblrThread
+import fxtumblr.tracing
+from fxtumblr.tracing import continue_trace, span, start_span
 
+from .client import RENDERS_MAX_MESSAGE_SIZE
+from .paths import path_to
 from .render import setup_browser, close_browser, render_thread
 
 LOG_ENABLED = config.get("logging", False)
@@ -15,6 +28,7 @@ LOG_ENABLED = config.get("logging", False)
 class RenderServer:
     async def main_loop(self):
         """Main loop for the renderer."""
+        fxtumblr.tracing.service_name = "fxtumblr-render"
         await setup_browser()
 
         self.queue = asyncio.Queue()
@@ -23,11 +37,20 @@ class RenderServer:
             w = asyncio.create_task(self.worker(f"worker-{i}"))
             self.workers.append(w)
 
+        # Clients waiting for each work ID currently queued or being rendered
+        self.waiters = {}
+
         server = await asyncio.start_server(
             self.handle_request,
             config.get("renders_host", "localhost"),
             int(config.get("renders_port", 6500)),
+            limit=RENDERS_MAX_MESSAGE_SIZE,
+        )
+        start_metrics_server(
+            int(config.get("renders_metrics_port", 6501)),
+            config.get("renders_host", "localhost"),
         )
+
         print("Render server ready.")
         async with server:
             await server.serve_forever()
@@ -46,63 +69,130 @@ class RenderServer:
         await close_browser()
 
     async def handle_request(self, reader, writer):
-        data = await reader.read(1024)
         try:
-            data = json.loads(data.decode())
-        except (ValueError, json.decoder.JSONDecodeError):
-            return
-
-        self.queue.put_nowait(
-            (
-                writer,
+            data = loads(await reader.readline())
+            work_id = data["work_id"]
+            work = (
                 data["blogname"],
                 data["post_id"],
                 data["modifiers"],
-                data["work_id"],
+                work_id,
+                data.get("post"),
+                data.get("traceparent"),
             )
-        )
+            # Work IDs are used as keys in self.waiters
+            hash(work_id)
+        except (ValueError, KeyError, TypeError):
+            writer.close()
+            return
+
+        # If the same work is already queued (e.g. a pre-render started by
+        # the embed and the crawler fetching the image), wait for its result
+        # instead of rendering it again.
+        if work_id in self.waiters:
+            self.waiters[work_id].append(writer)
+            return
+        self.waiters[work_id] = [writer]
+
+        self.queue.put_nowait((*work, time.time_ns()))
+        RENDER_QUEUE_DEPTH.set(self.queue.qsize())
+
+    async def render_post(
+        self, name, blogname, post_id, modifiers, work_id, post=None
+    ) -> bool:
+        """Fetches (if needed) and renders a post. Returns True on success."""
+        try:
+            if post is None:
+                with span("fetch"):
+                    post = get_post(blogname, post_id)
+            if not post:
+                raise ValueError
+            elif "errors" in post and post["errors"]:
+                raise ValueError("Post has error:", post)
+            with span("parse"):
+                thread = TumblrThread.from_payload(
+                    post, unroll=("unroll" in modifiers)
+                )
+        except:  # noqa: E722
+            print(
+                f"[{name}] Exception while fetching {blogname}-{post_id} with modifiers {modifiers} (work ID: {work_id}):"
+            )
+            traceback.print_exc()
+            return False
+
+        # slightly longer than render_thread timeout, x2 for error handling
+        async with asyncio.timeout(22):
+            try:
+                return await render_thread(thread, modifiers=modifiers)
+            except:  # noqa: E722
+                print(
+                    f"[{name}] Exception while rendering {blogname}-{post_id} with modifiers {modifiers} (work ID: {work_id}):"
+                )
+                traceback.print_exc()
+        return False
 
     async def worker(self, name):
         while True:
-            writer, blogname, post_id, modifiers, work_id = await self.queue.get()
-            ret = False
+            (
+                blogname,
+                post_id,
+                modifiers,
+                work_id,
+                post,
+                traceparent,
+                enqueued_ns,
+            ) = await self.queue.get()
+            RENDER_QUEUE_DEPTH.set(self.queue.qsize())
+            start = time.perf_counter()
 
             if LOG_ENABLED:
                 print(
                     f"[{name}] Rendering post {blogname}-{post_id} with modifiers {modifiers} (work ID: {work_id})"
                 )
 
-            try:
-                post = get_post(blogname, post_id)
-                if not post:
-                    raise ValueError
-                elif "errors" in post and post["errors"]:
-                    raise ValueError("Post has error:", post)
-                thread = TumblrThread.from_payload(post, unroll=("unroll" in modifiers))
-            except:  # noqa: E722
-                print(
-                    f"[{name}] Exception while fetching {blogname}-{post_id} with modifiers {modifiers} (work ID: {work_id}):"
+            with continue_trace(traceparent), span(
+                "render_server",
+                start_ns=enqueued_ns,
+                work_id=work_id,
+                worker=name,
+                prefetched=post is not None,
+            ) as server_span:
+                queue_wait = start_span("queue_wait", start_ns=enqueued_ns)
+                if queue_wait:
+                    queue_wait.end()
+
+                ret = await self.render_post(
+                    name, blogname, post_id, modifiers, work_id, post
                 )
-                traceback.print_exc()
-            else:
-                # slightly longer than render_thread timeout, x2 for error handling
-                async with asyncio.timeout(22):
-                    try:
-                        ret = await render_thread(thread, modifiers=modifiers)
-                    except:  # noqa: E722
-                        print(
-                            f"[{name}] Exception while rendering {blogname}-{post_id} with modifiers {modifiers} (work ID: {work_id}):"
+                if server_span:
+                    server_span.set_attribute("success", ret)
+
+            duration = time.perf_counter() - start
+            RENDER_WORKER_BUSY.labels(worker=name).inc(duration)
+            RENDER_DURATION.labels(result="success" if ret else "failure").observe(
+                duration
+            )
+            if ret:
+                try:
+                    RENDER_FILE_SIZE.observe(
+                        os.path.getsize(
+                            path_to(blogname, post_id, "png", modifiers=modifiers)
                         )
-                        traceback.print_exc()
+                    )
+                except OSError:
+                    pass
 
             if LOG_ENABLED:
                 print(
                     f"[{name}] Result for {blogname}-{post_id} with modifiers {modifiers} (work ID: {work_id}): {ret}"
                 )
 
-            writer.write(
-                bytes(json.dumps({"work_id": work_id, "return": ret}), "utf-8")
-            )
-            await writer.drain()
-            writer.close()
+            response = dumps({"work_id": work_id, "return": ret}) + b"\n"
+            for writer in self.waiters.pop(work_id, []):
+                try:
+                    writer.write(response)
+                    await writer.drain()
+                    writer.close()
+                except:  # noqa: E722
+                    traceback.print_exc()
             self.queue.task_done()
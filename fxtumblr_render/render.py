@@ -10,7 +10,9 @@ import traceback
 from typing import Optional
 
 from fxtumblr.config import config
+from fxtumblr.metrics import BROWSER_RESTARTS
 from fxtumblr.npf import TumblrThread
+from fxtumblr.tracing import span
 
 from .paths import RENDERS_PATH, filename_for
 
@@ -41,6 +43,9 @@ async def setup_browser() -> None:
     global browser
     global playwright_async
 
+    if browser is not None:
+        BROWSER_RESTARTS.inc()
+
     await close_browser()
 
     if BROWSER_TYPE == "pyppeteer":
@@ -116,11 +121,13 @@ async def render_thread(
         or f"{thread.blog_name}-{thread.id}" in config.get("renders_ignore_cache", [])
         or not os.path.exists(os.path.join(RENDERS_PATH, target_filename))
     ):
-        rendered_html = render_template.render(
-            thread=thread, fxtumblr_path=FXTUMBLR_PATH, modifiers=modifiers
-        )
-        with open(target_html_path, "w") as target_html:
-            target_html.write(rendered_html)
+        with span("template"):
+            rendered_html = render_template.render(
+                thread=thread, fxtumblr_path=FXTUMBLR_PATH, modifiers=modifiers
+            )
+        with span("file_write"):
+            with open(target_html_path, "w") as target_html:
+                target_html.write(rendered_html)
 
         ret = False
 
@@ -133,14 +140,16 @@ async def render_thread(
                 try:
                     async with asyncio.timeout(10):
                         await page.setViewport({"width": 540, "height": 100})
-                        await page.goto(f"file://{target_html_path}")
-                        await page.screenshot(
-                            {
-                                "path": os.path.join(RENDERS_PATH, target_filename),
-                                "fullPage": True,
-                                "omitBackground": True,
-                            }
-                        )
+                        with span("page_load"):
+                            await page.goto(f"file://{target_html_path}")
+                        with span("screenshot"):
+                            await page.screenshot(
+                                {
+                                    "path": os.path.join(RENDERS_PATH, target_filename),
+                                    "fullPage": True,
+                                    "omitBackground": True,
+                                }
+                            )
                 except (TimeoutError, asyncio.exceptions.CancelledError) as e:
                     print(
                         f"Timed out while rendering post: {thread.blog_name}-{thread.id}"
@@ -166,12 +175,14 @@ async def render_thread(
                 try:
                     async with asyncio.timeout(10):
                         await page.set_viewport_size({"width": 540, "height": 100})
-                        await page.goto(f"file://{target_html_path}")
-                        await page.screenshot(
-                            path=os.path.join(RENDERS_PATH, target_filename),
-                            full_page=True,
-                            omit_background=True,
-                        )
+                        with span("page_load"):
+                            await page.goto(f"file://{target_html_path}")
+                        with span("screenshot"):
+                            await page.screenshot(
+                                path=os.path.join(RENDERS_PATH, target_filename),
+                                full_page=True,
+                                omit_background=True,
+                            )
                 except (TimeoutError, asyncio.exceptions.CancelledError) as e:
                     print(
                         f"Timed out while rendering post: {thread.blog_name}-{thread.id}"
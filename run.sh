@@ -1,3 +1,6 @@
 #!/bin/sh
 export QUART_APP=fxtumblr.app
+# Used to aggregate metrics across workers; must be emptied on startup
+export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/fxtumblr-metrics}"
+rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
 hypercorn -w 4 'fxtumblr.app' -b 0.0.0.0:7878
@@ -5,10 +5,20 @@ Command-line tool to dump statistics.
 """
 
 import argparse
-from collections import namedtuple
+import collections
 import datetime
 
 from fxtumblr import config
+from fxtumblr.cache import r
+from fxtumblr.stats import (
+    ROLLUP_UPSERT,
+    STATS_MODIFIERS,
+    STATS_RAW_HITS,
+    STATS_SCHEMA,
+    HITS_COLUMNS,
+    modifiers_mask,
+    unique_key,
+)
 
 STATS_DB_TYPE = config.get("stats_db_type", "sqlite")
 if STATS_DB_TYPE == "sqlite":
@@ -29,6 +39,67 @@ elif STATS_DB_TYPE == "postgres":
 else:
     raise ValueError("stats_db_type must be one of: sqlite, postgres")
 
+
+def add_range_arguments(subparser):
+    subparser.add_argument(
+        "-d", "--days", type=int, help="How many days back to get the data for"
+    )
+    subparser.add_argument(
+        "-s", "--start-date", help="Start date (inclusive) for the data (YYYY-MM-DD)"
+    )
+    subparser.add_argument(
+        "-e", "--end-date", help="End date (inclusive) for the data (YYYY-MM-DD)"
+    )
+    subparser.add_argument(
+        "-m",
+        "--modifiers",
+        help="Only count cases where the provided modifiers (comma-separated) are used",
+    )
+
+
+def get_date_range(args):
+    """Returns the start and end date (both inclusive) from the arguments."""
+    if not args.days and not args.start_date:
+        raise ValueError("Must specify one of --days or --start-date")
+
+    now = datetime.datetime.now().replace(hour=0, minute=0, second=0)
+
+    if args.days:
+        start_date = now - datetime.timedelta(days=args.days)
+    elif args.start_date:
+        start_date = datetime.datetime.strptime(args.start_date, "%Y-%m-%d")
+
+    if args.end_date:
+        end_date = datetime.datetime.strptime(args.end_date, "%Y-%m-%d")
+    else:
+        end_date = now
+
+    if start_date > end_date:
+        raise ValueError("Start date is earlier than end date")
+
+    return start_date, end_date
+
+
+def get_modifiers_mask(args) -> int:
+    if not args.modifiers:
+        return 0
+    for mod in args.modifiers.split(","):
+        if mod not in STATS_MODIFIERS:
+            raise ValueError(f"Unknown modifier {mod}")
+    return modifiers_mask(args.modifiers.split(","))
+
+
+def approximate_unique_posts(dates, mask: int) -> int:
+    """
+    Returns the approximate number of unique posts hit on the given days,
+    with (at least) the given modifiers, from the HyperLogLogs in valkey.
+    """
+    masks = [m for m in range(1 << len(STATS_MODIFIERS)) if m & mask == mask]
+    keys = [unique_key(date, m) for date in dates for m in masks]
+    # PFCOUNT with multiple keys counts the union of the HLLs
+    return r.pfcount(*keys)
+
+
 # Argument parsing
 parser = argparse.ArgumentParser(
     prog="statstool.py", description="Tools for parsing fxtumblr instance statistics"
@@ -38,31 +109,55 @@ subparsers = parser.add_subparsers(title="mode")
 
 plot_parser = subparsers.add_parser("plot")
 plot_parser.set_defaults(mode="plot")
-plot_parser.add_argument(
-    "-d", "--days", type=int, help="How many days back to plot the data for"
-)
-plot_parser.add_argument(
-    "-s", "--start-date", help="Start date (inclusive) for the data (YYYY-MM-DD)"
-)
-plot_parser.add_argument(
-    "-e", "--end-date", help="End date (inclusive) for the data (YYYY-MM-DD)"
-)
+add_range_arguments(plot_parser)
 plot_parser.add_argument(
     "-u",
     "--unique",
     help="Only count unique hits (i.e. multiple hits of the same post are discarded)",
     action="store_true",
 )
+plot_parser.add_argument(
+    "-a",
+    "--approximate",
+    help="Count unique hits approximately, from valkey (implies --unique)",
+    action="store_true",
+)
 plot_parser.add_argument(
     "-p",
     "--print-only",
     help="Instead of generating plot, print the data",
     action="store_true",
 )
-plot_parser.add_argument(
-    "-m",
-    "--modifiers",
-    help="Only print cases where the provided modifiers (comma-separated) are used"
+
+unique_parser = subparsers.add_parser(
+    "unique", help="Print the approximate number of unique posts that were hit"
+)
+unique_parser.set_defaults(mode="unique")
+add_range_arguments(unique_parser)
+unique_parser.add_argument(
+    "-b",
+    "--by",
+    choices=("day", "week", "range"),
+    default="range",
+    help="Whether to count posts per day, per week or for the whole range",
+)
+
+migrate_parser = subparsers.add_parser(
+    "migrate", help="Convert statistics from the old one-row-per-hit table"
+)
+migrate_parser.set_defaults(mode="migrate")
+migrate_parser.add_argument(
+    "-k",
+    "--keep-old",
+    help="Rename the old table to fxtumblr_stats_old instead of dropping it",
+    action="store_true",
+)
+migrate_parser.add_argument(
+    "-b",
+    "--batch-size",
+    type=int,
+    default=10000,
+    help="How many hits to convert at once",
 )
 
 args = parser.parse_args()
@@ -74,75 +169,70 @@ except:
 
 # Plot
 if mode == "plot":
-    import matplotlib.pyplot as plt
-
-    if not args.days and not args.start_date:
-        raise ValueError("Must specify one of --days or --start-date")
-
-    now = datetime.datetime.now().replace(hour=0, minute=0, second=0)
-
-    if args.days:
-        start_date = now - datetime.timedelta(days=args.days)
-    elif args.start_date:
-        start_date = datetime.datetime.strptime(args.start_date, "%Y-%m-%d")
-
-    if args.end_date:
-        end_date = datetime.datetime.strptime(args.end_date, "%Y-%m-%d")
-    else:
-        end_date = now
+    if args.unique and not args.approximate and not STATS_RAW_HITS:
+        # Without raw hits, fxtumblr_stats_hits is empty
+        print(
+            "Unique hits can't be counted exactly with stats_raw_hits disabled;"
+            " use --approximate to count them from valkey instead."
+        )
+        quit(1)
 
-    if start_date > end_date:
-        raise ValueError("Start date is earlier than end date")
+    import matplotlib.pyplot as plt
 
+    start_date, end_date = get_date_range(args)
     delta = end_date - start_date
 
     start_date_epoch = int(start_date.strftime("%s"))
     end_date_epoch = int((end_date + datetime.timedelta(days=1)).strftime("%s")) - 1
 
-    modifiers = []
-    if args.modifiers:
-        modifiers = args.modifiers.split(",")
+    mask = get_modifiers_mask(args)
 
-    hit_tuple = namedtuple("hit_tuple", "id time post modifiers failed")
-    hits = []
-    data = {}
+    # Day boundaries are in local time, so they're passed in with the query
+    # rather than computed from the timestamps
+    days = []
     for i in range(delta.days + 1):
         checked_date = start_date + datetime.timedelta(days=i)
         checked_date_start_epoch = int(checked_date.strftime("%s"))
         checked_date_end_epoch = (
             int((checked_date + datetime.timedelta(days=1)).strftime("%s")) - 1
         )
+        days.append((i, checked_date_start_epoch, checked_date_end_epoch))
 
-        hits_for_day = []
-        posts = set()
-        if STATS_DB_TYPE == "sqlite":
-            with sqlite3.connect(STATS_DB) as db:
-                fetch = db.execute(
-                    f"SELECT * FROM fxtumblr_stats WHERE time BETWEEN {checked_date_start_epoch} AND {checked_date_end_epoch};"
-                ).fetchall()
-        elif STATS_DB_TYPE == "postgres":
-            with psycopg.connect(PSQL_DSN) as conn:
-                with conn.cursor() as cur:
-                    fetch = cur.execute(
-                        f"SELECT * FROM fxtumblr_stats WHERE time BETWEEN {checked_date_start_epoch} AND {checked_date_end_epoch};"
-                ).fetchall()
-
-        for hit in fetch:
-            hit_parsed = hit_tuple(*hit)._asdict()
-            if args.unique and hit_parsed["post"] in posts:
-                continue
-            if modifiers:
-                skip = False
-                for mod in modifiers:
-                    if mod not in hit_parsed["modifiers"].split(","):
-                        skip = True
-                        break
-                if skip:
-                    continue
-            posts.add(hit_parsed["post"])
-            hits_for_day.append(hit_parsed)
-
-        data[checked_date.strftime("%Y-%m-%d")] = len(hits_for_day)
+    if args.unique:
+        table = "fxtumblr_stats_hits"
+        count = "COUNT(DISTINCT s.post)"
+    else:
+        table = "fxtumblr_stats_rollup"
+        count = "CAST(SUM(s.hits) AS BIGINT)"
+
+    query = f"""
+        WITH days (day, day_start, day_end) AS (
+            VALUES {", ".join(f"({i}, {start}, {end})" for i, start, end in days)}
+        )
+        SELECT days.day, {count}
+        FROM days JOIN {table} s ON s.time BETWEEN days.day_start AND days.day_end
+        WHERE s.time BETWEEN {start_date_epoch} AND {end_date_epoch}
+        {f"AND s.modifiers & {mask} = {mask}" if mask else ""}
+        GROUP BY days.day;
+    """
+
+    if args.approximate:
+        fetch = []
+        for i, _, _ in days:
+            date = (start_date + datetime.timedelta(days=i)).date()
+            fetch.append((i, approximate_unique_posts([date], mask)))
+    elif STATS_DB_TYPE == "sqlite":
+        with sqlite3.connect(STATS_DB) as db:
+            fetch = db.execute(query).fetchall()
+    elif STATS_DB_TYPE == "postgres":
+        with psycopg.connect(PSQL_DSN) as conn:
+            fetch = conn.execute(query).fetchall()
+
+    hits_per_day = dict(fetch)
+    data = {}
+    for i in range(delta.days + 1):
+        checked_date = start_date + datetime.timedelta(days=i)
+        data[checked_date.strftime("%Y-%m-%d")] = hits_per_day.get(i, 0)
 
     if args.print_only:
         for date, hits in data.items():
@@ -157,3 +247,97 @@ if mode == "plot":
         fig.savefig("stats.png")
 
         print("Done! Saved as stats.png")
+
+# Approximate unique posts
+elif mode == "unique":
+    start_date, end_date = get_date_range(args)
+    mask = get_modifiers_mask(args)
+
+    dates = [
+        (start_date + datetime.timedelta(days=i)).date()
+        for i in range((end_date - start_date).days + 1)
+    ]
+    if args.by == "day":
+        groups = {date.isoformat(): [date] for date in dates}
+    elif args.by == "week":
+        groups = {}
+        for date in dates:
+            year, week, _ = date.isocalendar()
+            groups.setdefault(f"{year}-W{week:02}", []).append(date)
+    else:
+        groups = {f"{dates[0].isoformat()} to {dates[-1].isoformat()}": dates}
+
+    for label, group_dates in groups.items():
+        print(f"{label}: ~{approximate_unique_posts(group_dates, mask)} unique posts")
+
+# Migrate
+elif mode == "migrate":
+    if STATS_DB_TYPE == "sqlite":
+        conn = sqlite3.connect(STATS_DB)
+        param = "?"
+        old_table_exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'fxtumblr_stats';"
+        ).fetchone()
+    elif STATS_DB_TYPE == "postgres":
+        conn = psycopg.connect(PSQL_DSN)
+        param = "%s"
+        old_table_exists = conn.execute(
+            "SELECT to_regclass('fxtumblr_stats');"
+        ).fetchone()[0]
+
+    if not old_table_exists:
+        print("Nothing to migrate (the fxtumblr_stats table doesn't exist)")
+        quit(0)
+
+    # Everything happens in one transaction, so if anything fails, the
+    # database is left as it was
+    with conn:
+        for statement in STATS_SCHEMA:
+            conn.execute(statement)
+
+        if STATS_DB_TYPE == "sqlite":
+            old = conn.cursor()
+        else:
+            # Server-side cursor, to not load the whole table at once
+            old = conn.cursor(name="fxtumblr_stats_migrate")
+        old.execute("SELECT time, post, modifiers, failed FROM fxtumblr_stats;")
+
+        counts = collections.Counter()
+        migrated = 0
+        while True:
+            batch = old.fetchmany(args.batch_size)
+            if not batch:
+                break
+            rows = [
+                (
+                    time,
+                    # The first 64 bits of the old hash, same as hash_post
+                    int.from_bytes(bytes.fromhex(post[:16]), "big", signed=True),
+                    modifiers_mask((modifiers or "").split(",")),
+                    bool(failed),
+                )
+                for time, post, modifiers, failed in batch
+            ]
+            counts.update((time, mods, failed) for time, _, mods, failed in rows)
+            if STATS_RAW_HITS:
+                conn.cursor().executemany(
+                    f"INSERT INTO fxtumblr_stats_hits {HITS_COLUMNS}"
+                    f" VALUES ({param}, {param}, {param}, {param});",
+                    rows,
+                )
+            migrated += len(rows)
+            print(f"Converted {migrated} hits...")
+        old.close()
+
+        conn.cursor().executemany(
+            ROLLUP_UPSERT.format(param),
+            [(*key, hits) for key, hits in counts.items()],
+        )
+
+        if args.keep_old:
+            conn.execute("ALTER TABLE fxtumblr_stats RENAME TO fxtumblr_stats_old;")
+        else:
+            conn.execute("DROP TABLE fxtumblr_stats;")
+
+    conn.close()
+    print(f"Done! Migrated {migrated} hits into {len(counts)} buckets")
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# fxtumblr reads config.yml from the working directory on import
+_tests_dir = os.path.dirname(os.path.abspath(__file__))
+os.chdir(_tests_dir)
+sys.path.insert(0, os.path.dirname(_tests_dir))
@@ -0,0 +1,27 @@
+import asyncio
+
+from fxtumblr.admission import AdmissionController, Priority
+
+
+def test_release_at_queue_timeout():
+    """
+    A slot handed over by release() in the same loop iteration as the
+    waiter's queue timeout must not be lost (on Python 3.12+, wait_for
+    raises TimeoutError even though the future has a result).
+    """
+
+    async def run():
+        controller = AdmissionController(1, 0.05)
+        assert controller.try_acquire(Priority.CACHED)
+
+        loop = asyncio.get_running_loop()
+        loop.call_at(loop.time() + 0.05, controller.release)
+        acquired = await controller.acquire(Priority.CACHED)
+        if acquired:
+            controller.release()
+        return acquired, controller.active
+
+    acquired, active = asyncio.run(run())
+    assert acquired
+    assert active == 0
+